@@ -14,10 +14,15 @@ import os.path
 from pprint import pprint
 import modules.ui
 import ldm.modules.attention as atm
-from modules import shared,scripts,extra_networks,devices,paths
+from modules import shared,scripts,extra_networks,devices,paths,sd_hijack
 from modules.processing import Processed
 from modules.script_callbacks import CFGDenoisedParams, on_cfg_denoised ,CFGDenoiserParams,on_cfg_denoiser
 import json # Presets.
+import re
+import fnmatch
+import weakref
+from collections import OrderedDict, namedtuple
+from types import SimpleNamespace
 
 #'"name","mode","divide ratios,"use base","baseratios","usecom","usencom",\n'
 """
@@ -46,12 +51,22 @@ orig_lora_Linear_forward = None
 orig_lora_Conv2d_forward = None
 lactive = False
 labug =False
+loralimit = 0 # Bytes of merged LoRA weights kept on device, see lorastore.
+lorabytes = 0
+loraindex = {} # Loaded LoRA modules by layer name, see loraindexer.
+loraplaced = OrderedDict() # LoRAs moved to the model device (weak references), least recently used first, see placeloras.
+loraplacelimit = 0
+filtercache = {} # Latent masks, kept across jobs.
+tokencache = OrderedDict() # Token counts of prompt chunks, see tokendealer.
+spancache = OrderedDict() # tokendealer results of whole prompts.
+tokenstats = [0, 0, 0] # Chunk cache hits, misses, whole prompt hits.
+layoutcache = OrderedDict() # Parsed prompt layouts, see parselayout.
 
 PRESETS =[
-    ["Vertical-3", "Vertical",'1,1,1',"",False,False,False,"Attention",False,"0","0"],
-    ["Horizontal-3", "Horizontal",'1,1,1',"",False,False,False,"Attention",False,"0","0"],
-    ["Horizontal-7", "Horizontal",'1,1,1,1,1,1,1',"0.2",True,False,False,"Attention",False,"0","0"],
-    ["Twod-2-1", "Horizontal",'1,2,3;1,1',"0.2",False,False,False,"Attention",False,"0","0"],
+    ["Vertical-3", "Vertical",'1,1,1',"",False,False,False,"Attention",False,"0","0",True,True,"Einsum","1024",True,"0","2048",False,"4096","0,1","0","",False],
+    ["Horizontal-3", "Horizontal",'1,1,1',"",False,False,False,"Attention",False,"0","0",True,True,"Einsum","1024",True,"0","2048",False,"4096","0,1","0","",False],
+    ["Horizontal-7", "Horizontal",'1,1,1,1,1,1,1',"0.2",True,False,False,"Attention",False,"0","0",True,True,"Einsum","1024",True,"0","2048",False,"4096","0,1","0","",False],
+    ["Twod-2-1", "Horizontal",'1,2,3;1,1',"0.2",False,False,False,"Attention",False,"0","0",True,True,"Einsum","1024",True,"0","2048",False,"4096","0,1","0","",False],
 ]
 # SBM Keywords and delimiters for region breaks, following matlab rules.
 # BREAK keyword is now passed through,  
@@ -62,11 +77,17 @@ KEYCOMM = "ADDCOMM"
 KEYBRK = "BREAK"
 DELIMROW = ";"
 DELIMCOL = ","
+DELIMSAMPLE = "|" # Ratios of every image of a batch, see sampledealer.
 NLN = "\n"
 #MATMODE = "Matrix"
 TOKENSCON = 77
 TOKENS = 75
 MCOLOUR = 256
+FILTERCACHE = 8 # Latent masks kept for this many sizes / layouts.
+CONTEXTCACHE = 8 # Region contexts kept for this many context tensors (pos / neg, chunks).
+TOKENCACHE = 1024 # Prompt chunks kept with their token counts.
+SPANCACHE = 64 # Whole prompts kept with their token spans.
+LAYOUTCACHE = 64 # Prompt layouts kept parsed.
 ATTNSCALE = 8 # Initial image compression in attention layers.
 DKEYINOUT = { # Out/in, horizontal/vertical or row/col first.
 ("out",False): KEYROW,
@@ -99,6 +120,19 @@ PRESET_KEYS = [
 ("nchangeand", fjbool, False) ,
 ("lnter", fjstr, "0") ,
 ("lnur", fjstr, "0") ,
+("batchregions", fjbool, True) ,
+("cropregions", fjbool, True) ,
+("backend", fjstr, "Einsum") ,
+("slicesize", fjstr, "1024") ,
+("onechannel", fjbool, True) ,
+("feather", fjstr, "0") ,
+("lorabudget", fjstr, "2048") ,
+("batchlora", fjbool, False) ,
+("loravram", fjstr, "4096") ,
+("regionsteps", fjstr, "0,1") ,
+("regionsigma", fjstr, "0") ,
+("regionblocks", fjstr, "") ,
+("singleneg", fjbool, False) ,
 ]
 
 class RegionCell():
@@ -162,7 +196,7 @@ def split_l2(s, kr, kc, indsingles = False, fmap = fidentity, basestruct = None,
     The fmap function is applied to each cell before insertion to L2;
     if it fails, a default value is used.
     If flipped, the keyword for columns is applied before rows.
-    TODO: Needs to be a case insensitive split. Use re.split.
+    Prompts are split by layouttokens instead, which ignores case.
     """
     if indflip:
         tmp = kr
@@ -288,6 +322,144 @@ def list_rangify(l):
         lret = row3
     return lret
 
+# Prompt layout, shared by all jobs with the same prompt and settings - never edit it.
+# keys: keywords found in any case. rows: RegionRows of the 2d regions, or one row for 1d ratios.
+# prompt: prompt with region keys as breaks and base first, common part (comprompt) cut off.
+RegionLayout = namedtuple("RegionLayout", ["keys", "indexperiment", "usebase", "usecom", "basebreak", "comprompt", "prompt", "rows"])
+KEYSPLIT = re.compile("({})".format("|".join([KEYROW, KEYCOL, KEYBASE, KEYCOMM, KEYBRK])), re.IGNORECASE)
+
+def layouttokens(prompt):
+    """Split a prompt to texts and the keywords between them in one pass.
+    
+    Returns (texts, keys, raws, found): keys[i] (upper case) follows texts[i], raws[i] is as written.
+    Region keywords ignore case. BREAK only splits as written (as in webui), other cases stay text,
+    but every keyword is in found.
+    """
+    parts = KEYSPLIT.split(prompt)
+    texts, keys, raws, found = [], [], [], set()
+    text = parts[0]
+    for i in range(1, len(parts), 2):
+        key = parts[i].upper()
+        found.add(key)
+        if key == KEYBRK and parts[i] != KEYBRK:
+            text = text + parts[i] + parts[i + 1]
+            continue
+        texts.append(text)
+        keys.append(key)
+        raws.append(parts[i])
+        text = parts[i + 1]
+    texts.append(text)
+    return texts, keys, raws, found
+
+def tokenjoin(texts, raws, st, ed, keys = None):
+    """Text of texts[st:ed] with the keywords between them. Keys in keys are written as breaks."""
+    out = texts[st]
+    for i in range(st, ed - 1):
+        out = out + (KEYBRK if keys is not None and raws[i].upper() in keys else raws[i]) + texts[i + 1]
+    return out
+
+def firstkey(keys, key, st = 0):
+    """Index of the first key from st, None if missing."""
+    for i in range(st, len(keys)):
+        if keys[i] == key:
+            return i
+    return None
+
+def commoncut(keys):
+    """Key ending the common part: the first ADDCOMM, else the first BREAK."""
+    i = firstkey(keys, KEYCOMM)
+    return firstkey(keys, KEYBRK) if i is None else i
+
+def parselayout(prompt, aratios, bratios, mode, usebase, usecom):
+    """Regions, breaks, base and common parts of a prompt and its ratios, memoized.
+    
+    Used by process and the template preview. Without 2d keywords or row ratios,
+    rows hold the comma ratios as one row and the prompt is kept as is.
+    """
+    key = (prompt, aratios, bratios, mode, usebase, usecom)
+    layout = layoutcache.get(key)
+    if layout is not None:
+        layoutcache.move_to_end(key)
+        return layout
+    texts, keys, raws, found = layouttokens(prompt)
+    indexperiment = KEYROW in found or KEYCOL in found or DELIMROW in aratios
+    usecom = usecom or KEYCOMM in found # Automatic common toggle.
+    indflip = (mode == "Vertical")
+    comprompt = None
+    basebreak = 0
+    baseprompt = ""
+    st = 0 # Text index where the main prompt starts.
+    if indexperiment:
+        if usecom:
+            i = commoncut(keys)
+            if i is not None:
+                comprompt = tokenjoin(texts, raws, 0, i + 1)
+                st = i + 1
+        # The addrow/addcol syntax is better, cannot detect regular breaks without it.
+        # In any case, the preferred method will anchor the L2 structure.
+        i = firstkey(keys, KEYBASE, st) # Designated base.
+        if i is not None:
+            usebase = True
+            basebreak = keys[st:i].count(KEYBRK)
+        elif usebase: # Get base by first break as usual.
+            i = firstkey(keys, KEYBRK, st)
+        if usebase and i is not None:
+            baseprompt = tokenjoin(texts, raws, st, i + 1)
+            st = i + 1
+    mkeys = keys[st:]
+    if KEYROW in mkeys or KEYCOL in mkeys:
+        # Prompt anchors, count breaks between special keywords.
+        (kout, kin) = (KEYCOL, KEYROW) if indflip else (KEYROW, KEYCOL)
+        lbreaks = [[0]]
+        for k in mkeys:
+            if k == kout:
+                lbreaks.append([0])
+            elif k == kin:
+                lbreaks[-1].append(0)
+            elif k == KEYBRK:
+                lbreaks[-1][-1] += 1
+        if DELIMROW not in aratios and (KEYROW in mkeys) != (KEYCOL in mkeys):
+            # By popular demand, 1d integrated into 2d.
+            # This works by either adding a single row value (inner),
+            # or setting flip to the reverse (outer).
+            # Only applies when using just ADDROW / ADDCOL keys, and commas in ratio.
+            indflip2 = False
+            if (KEYROW in mkeys) == indflip:
+                aratios = "1" + DELIMCOL + aratios
+            else:
+                indflip2 = True
+            (aratios2r,aratios2) = split_l2(aratios, DELIMROW, DELIMCOL, indsingles = True,
+                                fmap = ffloatd(1), basestruct = lbreaks, indflip = indflip2)
+        else: # Standard ratios, split to rows and cols.
+            (aratios2r,aratios2) = split_l2(aratios, DELIMROW, DELIMCOL, indsingles = True,
+                                            fmap = ffloatd(1), basestruct = lbreaks, indflip = indflip)
+    elif indexperiment:
+        (aratios2r,aratios2) = split_l2(aratios, DELIMROW, DELIMCOL, indsingles = True, fmap = ffloatd(1), indflip = indflip)
+        # Cannot determine which breaks matter.
+        lbreaks = split_l2("0", KEYROW, KEYCOL, fmap = fint, basestruct = aratios2, indflip = indflip)
+    else: # Commas only - 1d.
+        aratios2 = split_l2(aratios, DELIMROW, DELIMCOL, fmap = ffloatd(1))
+        aratios2r = [1]
+        lbreaks = split_l2("0", KEYROW, KEYCOL, fmap = fint, basestruct = aratios2)
+    # More like "bweights", applied per cell only.
+    bratios2 = split_l2(bratios, DELIMROW, DELIMCOL, fmap = ffloatd(0), basestruct = lbreaks, indflip = indflip)
+
+    # Change all splitters to breaks.
+    aratios2 = list_rangify(list_cumsum(list_percentify(aratios2)))
+    aratios2r = list_rangify(list_cumsum(list_percentify(aratios2r)))
+    # Merge various L2s to cells and rows.
+    rows = tuple(RegionRow(aratios2r[r][0], aratios2r[r][1],
+                           tuple(RegionCell(aratios2[r][c][0], aratios2[r][c][1], bratios2[r][c], lbreaks[r][c])
+                                 for c,_ in enumerate(lbreaks[r])))
+                 for r,_ in enumerate(lbreaks))
+    if indexperiment: # Convert all keys to breaks.
+        prompt = tokenjoin(texts, raws, st, len(texts), keys = (KEYROW, KEYCOL))
+        if usebase:
+            prompt = baseprompt + fspace(KEYBRK) + prompt
+    layout = RegionLayout(frozenset(found), indexperiment, usebase, usecom, basebreak, comprompt, prompt, rows)
+    cacheput(layoutcache, key, layout, LAYOUTCACHE)
+    return layout
+
 def round_dim(x,y):
     """Return division of two numbers, rounding 0.5 up.
     
@@ -336,37 +508,605 @@ def split_dims(xs, height, width, **kwargs):
     
     return dsh,dsw
 
-def main_forward(module,x,context,mask,divide,isvanilla = False):
-    
-    # Forward.
+def heads_split(module, divide, isvanilla = False):
     h = module.heads
     if isvanilla: # SBM Ddim / plms have the context split ahead along with x.
         pass
     else: # SBM I think divide may be redundant.
         h = h // divide
+    return h
+
+def query_forward(module, x, divide, isvanilla = False):
+    """Query projection and head split, the same for every region of a layer."""
+    h = heads_split(module, divide, isvanilla)
     q = module.to_q(x)
+    return atm.rearrange(q, 'b n (h d) -> (b h) n d', h=h)
+
+def attention_forward(q, k, v, keep, scale, backend = "Einsum", slicesize = 0):
+    """softmax(q k^T * scale) v over the last two dims, leading dims broadcast.
+
+    Keep is a bool mask of the keys taking part, broadcastable to the attention matrix, or None.
+    Einsum builds the full matrix, SDPA hands it to torch (flash / memory efficient kernels),
+    Sliced runs the einsum path on chunks of slicesize queries to bound the peak memory.
+    """
+    if backend == "SDPA" and hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        # SDPA scales by 1 / sqrt(d), which is not module.scale once heads are divided.
+        q = q * (scale * math.sqrt(q.size()[-1]))
+        return torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask = keep)
+    if backend == "Sliced" and 0 < slicesize < q.size()[-2]:
+        out = q.new_empty(*torch.broadcast_shapes(q.shape[:-2], k.shape[:-2]), q.size()[-2], v.size()[-1])
+        for i in range(0, q.size()[-2], slicesize):
+            out[..., i:i + slicesize, :] = attention_forward(q[..., i:i + slicesize, :], k, v, keep, scale)
+        return out
+
+    sim = atm.einsum('... i d, ... j d -> ... i j', q, k) * scale
+
+    if atm.exists(keep):
+        max_neg_value = -torch.finfo(sim.dtype).max
+        sim.masked_fill_(~keep, max_neg_value)
+
+    attn = sim.softmax(dim=-1)
+
+    return atm.einsum('... i j, ... j d -> ... i d', attn, v)
+
+def main_forward(module,x,context,mask,divide,isvanilla = False,q = None,backend = "Einsum",slicesize = 0):
+    
+    # Forward.
+    h = heads_split(module, divide, isvanilla)
+    if q is None: # Callers forwarding several regions share a single query.
+        q = query_forward(module, x, divide, isvanilla)
     context = atm.default(context, x)
     k = module.to_k(context)
     v = module.to_v(context)
 
-    q, k, v = map(lambda t: atm.rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
-
-    sim = atm.einsum('b i d, b j d -> b i j', q, k) * module.scale
+    k, v = map(lambda t: atm.rearrange(t, 'b n (h d) -> (b h) n d', h=h), (k, v))
 
     if atm.exists(mask):
         mask = atm.rearrange(mask, 'b ... -> b (...)')
-        max_neg_value = -torch.finfo(sim.dtype).max
         mask = atm.repeat(mask, 'b j -> (b h) () j', h=h)
-        sim.masked_fill_(~mask, max_neg_value)
 
-    attn = sim.softmax(dim=-1)
+    out = attention_forward(q, k, v, mask, module.scale, backend, slicesize)
+    out = atm.rearrange(out, '(b h) n d -> b n (h d)', h=h)
+    out = module.to_out(out)
 
-    out = atm.einsum('b i j, b j d -> b i d', attn, v)
+    return out
+
+def padcontexts(contexts, mask):
+    """Pad contexts to a common token length and stack them along the batch.
+
+    Returns the stacked (regions * b, t, c) context and a (regions, b, t) mask
+    of the tokens to keep, padding is always dropped. Mask may be a list, one per context.
+    """
+    r = len(contexts)
+    b = contexts[0].size()[0]
+    tmax = max(c.size()[1] for c in contexts)
+    keep = torch.zeros(r, b, tmax, dtype = torch.bool, device = contexts[0].device)
+    lmask = mask if isinstance(mask, list) else [mask] * r
+    lpad = []
+    for i, c in enumerate(contexts):
+        t = c.size()[1]
+        mask = lmask[i]
+        if atm.exists(mask):
+            mask = atm.rearrange(mask, 'b ... -> b (...)')
+        keep[i, :, :t] = True if not atm.exists(mask) else mask[:, :t]
+        if t < tmax:
+            c = torch.cat([c, c.new_zeros(b, tmax - t, c.size()[2])], dim = 1)
+        lpad.append(c)
+    return torch.cat(lpad), keep
+
+def main_forward_batched(module,x,contexts,mask,divide,isvanilla = False,q = None,backend = "Einsum",slicesize = 0):
+    """Forward all region contexts in a single attention call.
+
+    Contexts are padded to a common token length and stacked along a region dim,
+    padded tokens are masked out of the softmax so results match main_forward.
+    The query is shared (broadcast) by all regions rather than repeated.
+    Returns a (regions, b, n, c) tensor.
+    """
+    h = heads_split(module, divide, isvanilla)
+    r = len(contexts)
+    context, keep = padcontexts(contexts, mask)
+
+    if q is None:
+        q = query_forward(module, x, divide, isvanilla)
+    k = module.to_k(context)
+    v = module.to_v(context)
+
+    k, v = map(lambda t: atm.rearrange(t, '(r b) n (h d) -> (b h) r n d', h=h, r=r), (k, v))
+    keep = atm.repeat(keep, 'r b j -> (b h) r () j', h=h)
+
+    out = attention_forward(q[:, None], k, v, keep, module.scale, backend, slicesize)
+    out = atm.rearrange(out, '(b h) r n d -> r b n (h d)', h=h)
+    out = module.to_out(out)
+
+    return out
+
+def main_forward_cropped(module,x,contexts,slots,pos,mask,divide,isvanilla = False,q = None,backend = "Einsum",slicesize = 0):
+    """Forward every token against the context of its owner region only.
+
+    Query tokens are grouped by region and padded to the largest region (see cropslots),
+    so attention rows are computed only for the tokens a region keeps.
+    Regions with no tokens are allowed. Returns the assembled (b, n, c) output.
+    """
+    h = heads_split(module, divide, isvanilla)
+    r = len(contexts)
+    lmax = slots.size()[0] // r
+    context, keep = padcontexts(contexts, mask)
+
+    if q is None:
+        q = query_forward(module, x, divide, isvanilla)
+    k = module.to_k(context)
+    v = module.to_v(context)
+    k, v = map(lambda t: atm.rearrange(t, '(r b) n (h d) -> (b h) r n d', h=h, r=r), (k, v))
+
+    q = q[:, slots].reshape(q.size()[0], r, lmax, q.size()[2])
+    keep = atm.repeat(keep, 'r b j -> (b h) r () j', h=h)
+
+    out = attention_forward(q, k, v, keep, module.scale, backend, slicesize)
+    out = atm.rearrange(out, 'b r n d -> b (r n) d')[:, pos]
     out = atm.rearrange(out, '(b h) n d -> b n (h d)', h=h)
     out = module.to_out(out)
-    
+
     return out
 
+def regioncontext(contexts, tl):
+    """Grab the tokens of one region from the full context."""
+    context = contexts[:, tl[0] * TOKENSCON : tl[1] * TOKENSCON, :]
+    # SBM Controlnet sends extra conds at the end of context, apply it to all regions.
+    cnet_ext = contexts.shape[1] - (contexts.shape[1] // TOKENSCON) * TOKENSCON
+    if cnet_ext > 0:
+        context = torch.cat([context,contexts[:,-cnet_ext:,:]],dim = 1)
+    return context
+
+def regiontokens(self, tll):
+    """Token range of every region context in region order, base first when used.
+
+    Unrelated breaks inside a 2d cell are skipped. Stops early if tll runs out.
+    """
+    if not self.indexperiment:
+        return tll
+    ltl = []
+    i = 0
+    if self.usebase:
+        ltl.append(tll[i])
+        i = i + 1 + self.basebreak
+    for drow in self.aratios:
+        for dcell in drow.cols:
+            if i >= len(tll):
+                return ltl
+            ltl.append(tll[i])
+            i = i + 1 + dcell.breaks
+    return ltl
+
+def mixcontexts(lpos, lneg, cond):
+    """Region contexts of a pass mixing cond and uncond rows.
+
+    Uncond rows take the negative regions, the last one repeated if there are fewer (eg a single negative).
+    Both are padded to a common token length, returns the contexts and (b, t) masks of the tokens to keep.
+    """
+    lctx, lmask = [], []
+    for r, cp in enumerate(lpos):
+        cn = lneg[min(r, len(lneg) - 1)]
+        tp, tn = cp.size()[1], cn.size()[1]
+        t = max(tp, tn)
+        pad = lambda c: torch.cat([c, c.new_zeros(c.size()[0], t - c.size()[1], c.size()[2])], dim = 1)
+        lctx.append(torch.where(cond[:, None, None], pad(cp), pad(cn)))
+        if tp == tn:
+            lmask.append(None)
+        else:
+            tokens = torch.arange(t, device = cp.device)
+            lmask.append(torch.where(cond[:, None], tokens < tp, tokens < tn))
+    return lctx, lmask
+
+def chunkkeys(prompts):
+    """Key of every BREAK chunk, equal for two chunks only if they match in every prompt of the job."""
+    lchunks = [pr.split(KEYBRK) for pr in prompts]
+    n = len(lchunks[0])
+    if any(len(chunks) != n for chunks in lchunks):
+        return list(range(n))
+    return [tuple(chunks[i] for chunks in lchunks) for i in range(n)]
+
+def regionkeys(self, roles):
+    """Chunk key of every region context, see chunkkeys. Mixed passes pair the cond and uncond keys."""
+    if roles is True or roles is False:
+        keys, tll = (self.ptkeys, self.pt) if roles else (self.ntkeys, self.nt)
+        if len(keys) != len(tll): # Unknown, no sharing.
+            return regionfill(self, list(range(len(regiontokens(self, tll)))))
+        return regionfill(self, regiontokens(self, keys))
+    lpos, lneg = regionkeys(self, True), regionkeys(self, False)
+    return [(k, lneg[min(r, len(lneg) - 1)]) for r, k in enumerate(lpos)]
+
+def regionfill(self, l):
+    """Per region list with fewer entries than regions (eg fewer negative chunks) filled with its last one.
+
+    Mixed passes give the last negative context to the remaining regions too, see mixcontexts.
+    """
+    n = len(regionrects(self.aratios, self.mode, self.indexperiment, self.usebase, self.divide))
+    return l + l[-1:] * (n - len(l))
+
+def regioncontexts(self, contexts, roles):
+    """Contexts of every region, sliced once per context tensor and reused by all layers.
+
+    Roles is True / False for a cond / uncond pass, or a tuple of row roles for a pass mixing both.
+    Returns the contexts, their key masks (None if all tokens are kept) in region order,
+    and the first region with the same prompt chunk for every region, so equal contexts are forwarded once.
+    Every layer of a UNet pass gets the same context, so it is keyed by storage, layout and version.
+    The cache holds the tensor itself, so its storage can't be reused by another one while cached.
+    """
+    key = (contexts.data_ptr(), contexts.size(), contexts.stride(), contexts._version, roles)
+    entry = self.ctxcache.get(key)
+    if entry is None:
+        if roles is True or roles is False:
+            tll = self.pt if roles else self.nt
+            lctx = regionfill(self, [regioncontext(contexts, tl) for tl in regiontokens(self, tll)])
+            lmask = [None] * len(lctx)
+        else:
+            cond = torch.tensor(roles, device = contexts.device)
+            lctx, lmask = mixcontexts(regioncontexts(self, contexts, True)[0], regioncontexts(self, contexts, False)[0], cond)
+        keys = regionkeys(self, roles)
+        ukeys = tuple(keys.index(k) for k in keys)
+        if len(self.ctxcache) >= CONTEXTCACHE:
+            self.ctxcache.clear()
+        entry = (contexts, lctx, lmask, ukeys)
+        self.ctxcache[key] = entry
+    return entry[1], entry[2], entry[3]
+
+def unetpass(self, x):
+    """Cond / uncond roles of the rows of a new UNet pass, called by its first hooked layer.
+
+    With the same token length everywhere, all rows use the positive regions as before,
+    unless the negative takes a single pass.
+    Otherwise roles follow the CFG batch recorded by denoiser_callback: cond rows first, uncond last,
+    passes take consecutive rows. Without it (other samplers), a pass of one batch alternates
+    cond / uncond and a larger one is split in halves, DDIM / PLMS have uncond first.
+    Sets self.roles to True / False for a single role pass, else a tuple per row.
+    With per sample layouts, also sets self.layoutruns from the image of every row, see layoutruns.
+    """
+    n = x.size()[0]
+    if self.eq and not self.singleneg and self.layouts is None:
+        self.roles = True
+        return
+    if self.cfgrows is not None and self.cfgrows[2] + n <= self.cfgrows[1]:
+        ncond, _, start = self.cfgrows
+        roles = tuple(start + i < ncond for i in range(n))
+        # Conds of an image are consecutive, uncond rows are one per image.
+        images = tuple(r * self.batch_size // ncond if r < ncond else r - ncond for r in range(start, start + n))
+        self.cfgrows[2] = start + n
+    elif n == self.batch_size:
+        self.cfgrows = None
+        roles = (self.pn,) * n
+        images = tuple(range(n))
+        self.pn = not self.pn
+    else:
+        self.cfgrows = None
+        roles = (not self.isvanilla,) * (n // 2) + (self.isvanilla,) * (n - n // 2)
+        images = tuple(range(n // 2)) + tuple(range(n - n // 2))
+    if self.layouts is not None:
+        self.layoutruns = layoutruns(self, images)
+    if self.eq and not self.singleneg:
+        self.roles = True
+        return
+    self.roles = roles[0] if len(set(roles)) == 1 else roles
+
+def condrows(cond):
+    """Rows of a cond tensor, SDXL conds are a dict of tensors with the same rows."""
+    if isinstance(cond, dict):
+        cond = next(iter(cond.values()))
+    return cond.shape[0]
+
+def cfgsplit(params):
+    """Cond rows, all rows and the next row of a UNet pass of the CFG batch, see unetpass.
+
+    Cond rows come first and uncond rows last, counted from text_cond / text_uncond.
+    When the uncond is skipped (negative guidance minimum sigma), all rows are cond.
+    None when the counts don't add up to the rows, then unetpass falls back to alternating passes.
+    """
+    n = params.x.shape[0]
+    # SBM Stale version workaround.
+    if not hasattr(params, "text_cond") or not hasattr(params, "text_uncond"):
+        return None
+    ncond = condrows(params.text_cond)
+    if ncond == n or ncond + condrows(params.text_uncond) == n:
+        return [ncond, n, 0]
+    return None
+
+def layoutruns(self, images):
+    """(start, end, layout) of every run of consecutive rows whose images share a layout, see sampledealer."""
+    lids = [self.rowlayouts[min(i, len(self.rowlayouts) - 1)] for i in images]
+    runs = []
+    st = 0
+    for i in range(1, len(lids) + 1):
+        if i == len(lids) or lids[i] != lids[st]:
+            runs.append((st, i, lids[st]))
+            st = i
+    return runs
+
+def regioncomposite(outs, plan, usebase):
+    """Assemble every token from the output of its owner region, then blend the base in.
+
+    With feathered edges every token is the weighted sum of the regions instead.
+    """
+    r, b, n, c = outs.size()
+    if plan.soft is not None:
+        ox = torch.einsum('r n, r b n c -> b n c', plan.soft.to(outs.dtype), outs)
+    else:
+        ox = outs.gather(0, plan.owner.view(1, 1, n, 1).expand(1, b, n, c))[0]
+    if usebase:
+        ox = torch.lerp(ox, outs[0], plan.weights(ox.dtype))
+    return ox
+
+def matcrops(aratios, dsh, dsw, mode):
+    """Integer (rows, cols) slices of every cell of a 2d split layer, in prompt order.
+
+    The last cell of a row and the last row absorb the rounding remainders.
+    """
+    if "Horizontal" in mode: # Map columns / rows first to outer / inner.
+        dsout = dsw
+        dsin = dsh
+    elif "Vertical" in mode:
+        dsout = dsh
+        dsin = dsw
+    crops = []
+    sumout = 0
+    for drow in aratios:
+        sumin = 0
+        for dcell in drow.cols:
+            addout = 0
+            addin = 0
+            sumin = sumin + int(dsin*dcell.ed) - int(dsin*dcell.st)
+            if dcell.ed >= 0.999:
+                addin = sumin - dsin
+                sumout = sumout + int(dsout*drow.ed) - int(dsout*drow.st)
+                if drow.ed >= 0.999:
+                    addout = sumout - dsout
+            if "Horizontal" in mode:
+                crops.append((slice(int(dsh*drow.st) + addout, int(dsh*drow.ed)),
+                              slice(int(dsw*dcell.st) + addin, int(dsw*dcell.ed))))
+            elif "Vertical" in mode: # Cols are the outer list, rows are cells.
+                crops.append((slice(int(dsh*dcell.st) + addin, int(dsh*dcell.ed)),
+                              slice(int(dsw*drow.st) + addout, int(dsw*drow.ed))))
+    return crops
+
+def regcrops(aratios, dsh, dsw, mode, usebase, divide):
+    """Token slices of every region of a 1d split layer, None for the base.
+
+    Horizontal crops index a (dsh, dsw) layer, vertical ones the flat dsh * dsw tokens.
+    The last region absorbs the rounding remainder.
+    """
+    crops = []
+    cad = 0 if usebase else 1
+    sumer = 0
+    for i in range(divide + int(usebase)):
+        if usebase:
+            if i == 0:
+                crops.append(None)
+                continue
+            area = aratios[i - 1]
+        else:
+            area = aratios[i]
+        add = 0
+        if "Horizontal" in mode:
+            sumer = sumer + int(dsw * area[1]) - int(dsw * area[0])
+            if i == divide - cad:
+                add = sumer - dsw
+            crops.append((slice(None), slice(int(dsw * area[0] + add), int(dsw * area[1]))))
+        elif "Vertical" in mode:
+            sumer = sumer + int(dsw * dsh * area[1]) - int(dsw * dsh * area[0])
+            if i == divide - cad:
+                add = sumer - dsw * dsh
+            crops.append((slice(int(dsw * dsh * area[0] + add), int(dsw * dsh * area[1])),))
+    return crops
+
+def regionwrite(ox, out, plan, r):
+    """Write the cropped output of region r into the layer, added by weight when feathered."""
+    out = out.reshape(out.size()[0], -1, out.size()[-1])
+    if plan.soft is None:
+        ox.index_copy_(1, plan.tokens[r], out)
+    else:
+        ox.index_add_(1, plan.tokens[r], out * plan.softweights(r, out.dtype))
+
+def regionrects(aratios, mode, indexperiment, usebase, divide = None):
+    """Fractional (top, bottom, left, right) of every region in context order, None for the base."""
+    rects = [None] if usebase else []
+    if indexperiment:
+        for drow in aratios:
+            for dcell in drow.cols:
+                if "Horizontal" in mode:
+                    rects.append((drow.st, drow.ed, dcell.st, dcell.ed))
+                elif "Vertical" in mode:
+                    rects.append((dcell.st, dcell.ed, drow.st, drow.ed))
+    else:
+        for area in aratios[:divide]:
+            if "Horizontal" in mode:
+                rects.append((0, 1, area[0], area[1]))
+            elif "Vertical" in mode:
+                rects.append((area[0], area[1], 0, 1))
+    return rects
+
+def softmaps(rects, dsh, dsw, fy, fx, device):
+    """Feathered weight of every region over a (dsh, dsw) grid, flattened to (regions, dsh * dsw).
+
+    Inner edges ramp linearly over fy / fx (fractions of the image height / width),
+    the image border is kept hard. Weights are normalized to sum to 1 on every token.
+    Shared by Attention mode layers and Latent mode masks.
+    """
+    ys = (torch.arange(dsh, device = device) + 0.5) / dsh
+    xs = (torch.arange(dsw, device = device) + 0.5) / dsw
+    def ramp(c, st, ed, f):
+        w = torch.ones_like(c)
+        if st > 0.001:
+            w = w * ((c - st) / f + 0.5).clamp(0, 1)
+        if ed < 0.999:
+            w = w * ((ed - c) / f + 0.5).clamp(0, 1)
+        return w
+    maps = []
+    for rect in rects:
+        if rect is None: # Base, blended separately.
+            maps.append(torch.zeros(dsh, dsw, device = device))
+            continue
+        top, bottom, left, right = rect
+        maps.append(ramp(ys, top, bottom, fy)[:, None] * ramp(xs, left, right, fx)[None, :])
+    maps = torch.stack(maps).reshape(len(rects), -1)
+    return maps / maps.sum(0, keepdim = True).clamp(min = 1e-6)
+
+def supportcrop(w, shape):
+    """Smallest slices of a layer holding every token a region has weight on."""
+    w = w.reshape(shape) > 0
+    crop = []
+    for d in range(len(shape)):
+        nz = w.any(dim = [e for e in range(len(shape)) if e != d]) if len(shape) > 1 else w
+        idx = torch.nonzero(nz).reshape(-1)
+        crop.append(slice(int(idx[0]), int(idx[-1]) + 1) if idx.numel() > 0 else slice(0, 0))
+    return tuple(crop)
+
+def cropslots(owner, r):
+    """Group the tokens of every region into a (regions, largest region) grid.
+
+    Returns the token read by every grid slot (padding reads token 0),
+    and the slot of every token to scatter the results back.
+    """
+    n = owner.size()[0]
+    counts = torch.bincount(owner, minlength = r)
+    lmax = int(counts.max())
+    order = torch.argsort(owner, stable = True)
+    starts = torch.cumsum(counts, 0) - counts
+    pos = torch.empty_like(owner)
+    pos[order] = torch.arange(n, device = owner.device) - starts[owner[order]] + owner[order] * lmax
+    slots = torch.zeros(r * lmax, dtype = torch.long, device = owner.device)
+    slots[pos] = torch.arange(n, device = owner.device)
+    return slots, pos
+
+class RegionPlan():
+    """Final integer region boundaries of one attention layer size."""
+    def __init__(self, xs, height, width, mode, indexperiment, aratios, bratios, usebase, divide, device, feather = 0):
+        """Regions are in context order, index 0 being the base when used. Feather is in image pixels."""
+        if indexperiment:
+            self.dsh, self.dsw = split_dims(xs, height, width)
+            self.shape = (self.dsh, self.dsw)
+            self.crops = matcrops(aratios, self.dsh, self.dsw, mode)
+            self.bases = [dcell.base for drow in aratios for dcell in drow.cols]
+            if usebase:
+                self.crops.insert(0, None)
+                self.bases.insert(0, 0)
+        else:
+            scale = round(math.sqrt(height * width / xs))
+            dsh = round(height / scale)
+            dsw = round(width / scale)
+            ha, wa = xs % dsh, xs % dsw
+            if ha == 0:
+                dsw = int(xs / dsh)
+            elif wa == 0:
+                dsh = int(xs / dsw)
+            self.dsh, self.dsw = dsh, dsw
+            self.shape = (dsh, dsw) if "Horizontal" in mode else (dsh * dsw,)
+            self.crops = regcrops(aratios, dsh, dsw, mode, usebase, divide)
+            self.bases = [0] + bratios[:divide] if usebase else [0] * divide
+        # Owner region and base weight of every token, for compositing in one gather.
+        owner = torch.zeros(self.shape, dtype = torch.long, device = device)
+        bweight = torch.zeros(self.shape, device = device)
+        for r, crop in enumerate(self.crops):
+            if crop is None:
+                continue
+            owner[crop] = r
+            bweight[crop] = self.bases[r]
+        self.owner = owner.reshape(-1)
+        self.bweight = bweight.reshape(-1)
+        self.soft = None
+        if feather > 0:
+            # Feathered edges, regions overlap and are summed by weight. Crops grow to cover the ramps.
+            self.soft = softmaps(regionrects(aratios, mode, indexperiment, usebase, divide),
+                                 self.dsh, self.dsw, feather / height, feather / width, device)
+            self.bweight = (self.soft * torch.tensor(self.bases, dtype = self.soft.dtype, device = device)[:, None]).sum(0)
+            self.crops = [None if crop is None else supportcrop(w, self.shape) for crop, w in zip(self.crops, self.soft)]
+        # Flat token indices of every region, for writing region outputs in place.
+        index = torch.arange(self.owner.size()[0], device = device).reshape(self.shape)
+        self.tokens = [None if crop is None else index[crop].reshape(-1) for crop in self.crops]
+        self.slots, self.pos = cropslots(self.owner, len(self.crops))
+        self.nobase = not bool((self.bweight > 0).any()) # No token uses the base.
+        self.lweights = {}
+        self.groups = {}
+
+    def weights(self, dtype):
+        """Base weight map shaped (1, n, 1) for blending, cached per dtype."""
+        w = self.lweights.get(dtype)
+        if w is None:
+            w = self.bweight.to(dtype).view(1, -1, 1)
+            self.lweights[dtype] = w
+        return w
+
+    def softweights(self, r, dtype):
+        """Feathered weights of region r over its tokens, shaped (1, tokens, 1), cached per dtype."""
+        w = self.lweights.get((r, dtype))
+        if w is None:
+            w = self.soft[r][self.tokens[r]].to(dtype).view(1, -1, 1)
+            self.lweights[(r, dtype)] = w
+        return w
+
+    def regiongroups(self, ukeys, usebase):
+        """Regions worth a forward, grouped by equal context, cached per context map.
+
+        Ukeys is the first region with the same context as each region (see regioncontexts).
+        Skipped are regions with no tokens, regions replaced by the base (weight exactly 1, unless feathered)
+        and the base when no token uses it.
+        Returns the first region of every group, the group of every region (-1 if skipped),
+        the same as a gather index, and crop slots / positions of the tokens by group (see cropslots).
+        """
+        key = (ukeys, usebase)
+        entry = self.groups.get(key)
+        if entry is None:
+            device = self.owner.device
+            lgroups, first, gmap = {}, [], []
+            for r, u in enumerate(ukeys[:len(self.crops)]): # Contexts past the regions are unused.
+                if r == 0 and usebase:
+                    live = not self.nobase
+                else:
+                    live = self.tokens[r].numel() > 0 and not (usebase and self.soft is None and self.bases[r] == 1)
+                if not live:
+                    gmap.append(-1)
+                    continue
+                if u not in lgroups:
+                    lgroups[u] = len(first)
+                    first.append(r)
+                gmap.append(lgroups[u])
+            index = torch.tensor([max(g, 0) for g in gmap], device = device)
+            owner = torch.tensor(gmap, device = device)[self.owner]
+            keep = torch.nonzero(owner >= 0).reshape(-1)
+            slots = pos = None
+            if keep.numel() > 0: # Skipped tokens read any slot, the base replaces them.
+                slots, kpos = cropslots(owner[keep], len(first))
+                slots = keep[slots]
+                pos = torch.zeros_like(self.owner)
+                pos[keep] = kpos
+            entry = (first, gmap, index, slots, pos)
+            self.groups[key] = entry
+        return entry
+
+    def __repr__(self):
+        """Debug print."""
+        return "Plan {}x{}, crops {}".format(self.dsh, self.dsw, self.crops) + NLN
+
+def hr_cheker(n):
+    return (n != 0) and (n & (n - 1) == 0)
+
+def layer_hw(self, xs):
+    """Image size used to split a layer of xs tokens, the hires. fix size when the base one doesn't fit."""
+    height = self.h
+    width = self.w
+    if not hr_cheker(height * width // xs) and self.hr:
+        height = self.hr_h
+        width = self.hr_w
+    return height, width
+
+def regionplan(self, xs, height, width, device):
+    """Look up the region plan of a layer size, building it on first use."""
+    key = (xs, height, width, self.mode)
+    plan = self.plans.get(key)
+    if plan is None:
+        plan = RegionPlan(xs, height, width, self.mode, self.indexperiment,
+                          self.aratios, self.bratios, self.usebase, self.divide, device, self.feather)
+        self.plans[key] = plan
+        if self.debug : print(plan)
+    return plan
+
 def isfloat(t):
     try:
         float(t)
@@ -387,8 +1127,9 @@ class Script(modules.scripts.Script):
         self.aratios = []
         self.bratios = []
         self.divide = 0
-        self.count = 0
         self.pn = True
+        self.roles = True
+        self.cfgrows = None
         self.hr = False
         self.hr_scale = 0
         self.hr_w = 0
@@ -399,9 +1140,30 @@ class Script(modules.scripts.Script):
         self.all_prompts = []
         self.all_negative_prompts = []
         self.imgcount = 0
-        self.filters = []
+        self.onechannel = True
+        self.feather = 0
+        self.batchlora = False
+        self.regionsteps = [0, 1]
+        self.regionsigma = 0
+        self.regionon = True
+        self.blocks = None
+        self.blockhits = {}
+        self.singleneg = False
+        self.orders = {}
         self.anded = False
         self.lora_applied = False
+        self.plans = {}
+        self.ctxcache = {}
+        self.ptkeys = []
+        self.ntkeys = []
+        self.layouts = None
+        self.layoutindex = []
+        self.rowlayouts = ()
+        self.layoutruns = ()
+        self.batchregions = True
+        self.cropregions = True
+        self.backend = "Einsum"
+        self.slicesize = 0
 
     def title(self):
         return "Regional Prompter"
@@ -459,7 +1221,29 @@ class Script(modules.scripts.Script):
                 debug = gr.Checkbox(value=False, label="debug", interactive=True, elem_id="RP_debug")
                 lnter = gr.Textbox(label="LoRA in negative textencoder",value="0",interactive=True,elem_id="RP_ne_tenc_ratio",visible=True)
                 lnur = gr.Textbox(label="LoRA in negative U-net",value="0",interactive=True,elem_id="RP_ne_unet_ratio",visible=True)
-            settings = [mode, ratios, baseratios, usebase, usecom, usencom, calcmode, nchangeand, lnter, lnur]
+            with gr.Accordion("Region options",open = False):
+                with gr.Row():
+                    feather = gr.Textbox(label="Feather width (px)",value="0",interactive=True,elem_id="RP_feather",visible=True)
+                    regionblocks = gr.Textbox(label="Region blocks",value="",interactive=True,elem_id="RP_region_blocks",visible=True)
+                with gr.Row():
+                    regionsteps = gr.Textbox(label="Region steps",value="0,1",interactive=True,elem_id="RP_region_steps",visible=True)
+                    regionsigma = gr.Textbox(label="Region min sigma",value="0",interactive=True,elem_id="RP_region_sigma",visible=True)
+                with gr.Row():
+                    singleneg = gr.Checkbox(value=False, label="single negative pass", interactive=True, elem_id="RP_singleneg")
+            with gr.Accordion("Optimization",open = False):
+                with gr.Row():
+                    batchregions = gr.Checkbox(value=True, label="batch regions in one attention call (uses more VRAM)", interactive=True, elem_id="RP_batchregions")
+                    cropregions = gr.Checkbox(value=True, label="crop regions before attention", interactive=True, elem_id="RP_cropregions")
+                with gr.Row():
+                    backend = gr.Radio(label="Attention backend", choices=["Einsum", "SDPA", "Sliced"], value="Einsum",  type="value", interactive=True)
+                    slicesize = gr.Textbox(label="Slice size (Sliced backend)",lines=1,value="1024",interactive=True,elem_id="RP_slice_size",visible=True)
+                with gr.Row():
+                    onechannel = gr.Checkbox(value=True, label="1 channel latent masks (Latent mode, less memory)", interactive=True, elem_id="RP_onechannel")
+                    batchlora = gr.Checkbox(value=False, label="LoRA regions in one U-Net pass (Latent mode, uses more VRAM)", interactive=True, elem_id="RP_batchlora")
+                with gr.Row():
+                    lorabudget = gr.Textbox(label="LoRA cache budget (MB)",value="2048",interactive=True,elem_id="RP_lora_budget",visible=True)
+                    loravram = gr.Textbox(label="LoRA device budget (MB)",value="4096",interactive=True,elem_id="RP_lora_vram",visible=True)
+            settings = [mode, ratios, baseratios, usebase, usecom, usencom, calcmode, nchangeand, lnter, lnur, batchregions, cropregions, backend, slicesize, onechannel, feather, lorabudget, batchlora, loravram, regionsteps, regionsigma, regionblocks, singleneg]
         
         self.infotext_fields = [
                 (active, "RP Active"),
@@ -473,6 +1257,19 @@ class Script(modules.scripts.Script):
                 (nchangeand,"RP Change AND"),
                 (lnter,"RP LoRA Neg Te Ratios"),
                 (lnur,"RP LoRA Neg U Ratios"),
+                (batchregions,"RP Batch Regions"),
+                (cropregions,"RP Crop Regions"),
+                (backend,"RP Attention Backend"),
+                (slicesize,"RP Slice Size"),
+                (onechannel,"RP One Channel Masks"),
+                (feather,"RP Feather"),
+                (lorabudget,"RP LoRA Cache Budget"),
+                (batchlora,"RP Batch LoRA Regions"),
+                (loravram,"RP LoRA Device Budget"),
+                (regionsteps,"RP Region Steps"),
+                (regionsigma,"RP Region Min Sigma"),
+                (regionblocks,"RP Region Blocks"),
+                (singleneg,"RP Single Negative"),
         ]
 
         for _,name in self.infotext_fields:
@@ -489,19 +1286,9 @@ class Script(modules.scripts.Script):
         
         def makeimgtmp(aratios,mode,usecom,usebase):
             indflip = (mode == "Vertical")
-            if DELIMROW not in aratios: # Commas only - interpret as 1d.
-                aratios2 = split_l2(aratios, DELIMROW, DELIMCOL, fmap = ffloatd(1), indflip = False)
-                aratios2r = [1]
-            else:
-                (aratios2r,aratios2) = split_l2(aratios, DELIMROW, DELIMCOL, 
-                                                indsingles = True, fmap = ffloatd(1), indflip = indflip)
-            # Change all splitters to breaks.
-            aratios2 = list_percentify(aratios2)
-            aratios2 = list_cumsum(aratios2)
-            aratios2 = list_rangify(aratios2)
-            aratios2r = list_percentify(aratios2r)
-            aratios2r = list_cumsum(aratios2r)
-            aratios2r = list_rangify(aratios2r)
+            rows = parselayout("", aratios.split(DELIMSAMPLE)[0], "0", mode, False, False).rows
+            aratios2r = [[drow.st, drow.ed] for drow in rows]
+            aratios2 = [[[dcell.st, dcell.ed] for dcell in drow.cols] for drow in rows]
             
             h = w = 128
             fx = np.zeros((h,w, 3), np.uint8)
@@ -543,9 +1330,9 @@ class Script(modules.scripts.Script):
         applypresets.click(fn=setpreset, inputs = availablepresets, outputs=settings)
         savesets.click(fn=savepresets, inputs = [presetname,*settings],outputs=availablepresets)
                 
-        return [active, debug, mode, ratios, baseratios, usebase, usecom, usencom, calcmode, nchangeand, lnter, lnur]
+        return [active, debug, mode, ratios, baseratios, usebase, usecom, usencom, calcmode, nchangeand, lnter, lnur, batchregions, cropregions, backend, slicesize, onechannel, feather, lorabudget, batchlora, loravram, regionsteps, regionsigma, regionblocks, singleneg]
 
-    def process(self, p, active, debug, mode, aratios, bratios, usebase, usecom, usencom, calcmode, nchangeand, lnter, lnur):
+    def process(self, p, active, debug, mode, aratios, bratios, usebase, usecom, usencom, calcmode, nchangeand, lnter, lnur, batchregions, cropregions, backend, slicesize, onechannel, feather, lorabudget, batchlora, loravram, regionsteps, regionsigma, regionblocks, singleneg):
         if active:
             p.extra_generation_params.update({
                 "RP Active":active,
@@ -559,13 +1346,25 @@ class Script(modules.scripts.Script):
                 "RP Change AND" : nchangeand,
                 "RP LoRA Neg Te Ratios": lnter,
                 "RP LoRA Neg U Ratios": lnur,
+                "RP Batch Regions": batchregions,
+                "RP Crop Regions": cropregions,
+                "RP Attention Backend": backend,
+                "RP Slice Size": slicesize,
+                "RP One Channel Masks": onechannel,
+                "RP Feather": feather,
+                "RP LoRA Cache Budget": lorabudget,
+                "RP Batch LoRA Regions": batchlora,
+                "RP LoRA Device Budget": loravram,
+                "RP Region Steps": regionsteps,
+                "RP Region Min Sigma": regionsigma,
+                "RP Region Blocks": regionblocks,
+                "RP Single Negative": singleneg,
                     })
 
-            savepresets("lastrun",mode, aratios,bratios, usebase, usecom, usencom, calcmode, nchangeand, lnter, lnur)
+            savepresets("lastrun",mode, aratios,bratios, usebase, usecom, usencom, calcmode, nchangeand, lnter, lnur, batchregions, cropregions, backend, slicesize, onechannel, feather, lorabudget, batchlora, loravram, regionsteps, regionsigma, regionblocks, singleneg)
             self.__init__()
             self.active = True
             self.mode = mode
-            comprompt = comnegprompt = None
             # SBM ddim / plms detection.
             self.isvanilla = p.sampler_name in ["DDIM", "PLMS", "UniPC"]
 
@@ -578,9 +1377,14 @@ class Script(modules.scripts.Script):
                     p.all_prompts[i] = p.all_prompts[i].replace("AND",KEYBRK)
                 self.anded = True
 
-            if (KEYROW in p.prompt.upper() or KEYCOL in p.prompt.upper() or DELIMROW in aratios):
+            lratios = aratios.split(DELIMSAMPLE)
+            # Prompts and ratios of every image, a layout each when they differ, see sampledealer.
+            samples = [(pr, npr, lratios[i % len(lratios)]) for i, (pr, npr) in enumerate(zip(p.all_prompts, p.all_negative_prompts))]
+            uniform = all(sample == (p.prompt, p.negative_prompt, lratios[0]) for sample in samples)
+            layout = parselayout(p.prompt, lratios[0], bratios, mode, usebase, usecom)
+            if layout.indexperiment:
                 self.indexperiment = True
-            elif KEYBRK not in p.prompt.upper():
+            elif KEYBRK not in layout.keys:
                 self.active = False
                 unloader(self,p)
                 return
@@ -595,142 +1399,50 @@ class Script(modules.scripts.Script):
             self.batch_size = p.batch_size
             
             self.calcmode = calcmode
+            self.batchregions = batchregions
+            self.cropregions = cropregions
+            self.backend = backend
+            self.slicesize = int(floatdef(slicesize, 0))
+            self.onechannel = onechannel
+            self.feather = floatdef(feather, 0)
+            self.batchlora = batchlora
+            self.regionsteps = [floatdef(v, d) for v, d in zip((regionsteps + ",,").split(",")[:2], (0, 1))]
+            self.regionsigma = floatdef(regionsigma, 0)
+            self.regionon = True
+            if self.isvanilla and calcmode == "Attention" and (self.regionsteps != [0, 1] or self.regionsigma > 0):
+                # The window is set by denoiser_callback, which these samplers don't call.
+                print("Warning: Region steps / min sigma are ignored by DDIM / PLMS / UniPC, regions are used on every step.")
+            self.blocks = blockfilter(regionblocks)
+            self.singleneg = singleneg
 
             self.debug = debug
-            self.usebase = usebase
-            self.usecom = usecom
-            if KEYCOMM in p.prompt: # Automatic common toggle.
-                self.usecom = True
-            self.usencom = usencom
-            if KEYCOMM in p.negative_prompt: # Automatic common toggle.
-                self.usencom = True
-
             if hasattr(p,"enable_hr"): # Img2img doesn't have it.
                 self.hr = p.enable_hr
                 self.hr_w = (p.hr_resize_x if p.hr_resize_x > p.width else p.width * p.hr_scale)
                 self.hr_h = (p.hr_resize_y if p.hr_resize_y > p.height else p.height * p.hr_scale)
 
-            # SBM In matrix mode, the ratios are broken up 
-            if self.indexperiment:
-                if self.usecom and KEYCOMM in p.prompt:
-                    comprompt = p.prompt.split(KEYCOMM,1)[0]
-                    p.prompt = p.prompt.split(KEYCOMM,1)[1]
-                elif self.usecom and KEYBRK in p.prompt:
-                    comprompt = p.prompt.split(KEYBRK,1)[0]
-                    p.prompt = p.prompt.split(KEYBRK,1)[1]
-                if self.usencom and KEYCOMM in p.negative_prompt:
-                    comnegprompt = p.negative_prompt.split(KEYCOMM,1)[0]
-                    p.negative_prompt = p.negative_prompt.split(KEYCOMM,1)[1]
-                elif self.usencom and KEYBRK in p.negative_prompt:
-                    comnegprompt = p.negative_prompt.split(KEYBRK,1)[0]
-                    p.negative_prompt = p.negative_prompt.split(KEYBRK,1)[1]
-                # The addrow/addcol syntax is better, cannot detect regular breaks without it.
-                # In any case, the preferred method will anchor the L2 structure. 
-                if (KEYBASE in p.prompt.upper()): # Designated base.
-                    self.usebase = True
-                    baseprompt = p.prompt.split(KEYBASE,1)[0]
-                    mainprompt = p.prompt.split(KEYBASE,1)[1] 
-                    self.basebreak = fcountbrk(baseprompt)
-                elif usebase: # Get base by first break as usual.
-                    baseprompt = p.prompt.split(KEYBRK,1)[0]
-                    mainprompt = p.prompt.split(KEYBRK,1)[1]
-                else:
-                    baseprompt = ""
-                    mainprompt = p.prompt
-                indflip = (mode == "Vertical")
-                if (KEYCOL in mainprompt.upper() or KEYROW in mainprompt.upper()):
-                    breaks = mainprompt.count(KEYROW) + mainprompt.count(KEYCOL) + int(self.usebase)
-                    # Prompt anchors, count breaks between special keywords.
-                    lbreaks = split_l2(mainprompt, KEYROW, KEYCOL, fmap = fcountbrk, indflip = indflip)
-                    if (DELIMROW not in aratios
-                    and (KEYROW in mainprompt.upper()) != (KEYCOL in mainprompt.upper())):
-                        # By popular demand, 1d integrated into 2d.
-                        # This works by either adding a single row value (inner),
-                        # or setting flip to the reverse (outer).
-                        # Only applies when using just ADDROW / ADDCOL keys, and commas in ratio.
-                        indflip2 = False
-                        if (KEYROW in mainprompt.upper()) == indflip:
-                            aratios = "1" + DELIMCOL + aratios
-                        else:
-                            indflip2 = True
-                        (aratios2r,aratios2) = split_l2(aratios, DELIMROW, DELIMCOL, indsingles = True,
-                                            fmap = ffloatd(1), basestruct = lbreaks,
-                                            indflip = indflip2)
-                    else: # Standard ratios, split to rows and cols.
-                        (aratios2r,aratios2) = split_l2(aratios, DELIMROW, DELIMCOL, indsingles = True,
-                                                        fmap = ffloatd(1), basestruct = lbreaks, indflip = indflip)
-                    # More like "bweights", applied per cell only.
-                    bratios2 = split_l2(bratios, DELIMROW, DELIMCOL, fmap = ffloatd(0), basestruct = lbreaks, indflip = indflip)
-                else:
-                    breaks = mainprompt.count(KEYBRK) + int(self.usebase)
-                    (aratios2r,aratios2) = split_l2(aratios, DELIMROW, DELIMCOL, indsingles = True, fmap = ffloatd(1), indflip = indflip)
-                    # Cannot determine which breaks matter.
-                    lbreaks = split_l2("0", KEYROW, KEYCOL, fmap = fint, basestruct = aratios2, indflip = indflip)
-                    bratios2 = split_l2(bratios, DELIMROW, DELIMCOL, fmap = ffloatd(0), basestruct = lbreaks, indflip = indflip)
-                    # If insufficient breaks, try to broadcast prompt - a bit dumb.
-                    breaks = fcountbrk(mainprompt)
-                    lastprompt = mainprompt.rsplit(KEYBRK)[-1]
-                    if l2_count(aratios2) > breaks: 
-                        mainprompt = mainprompt + (fspace(KEYBRK) + lastprompt) * (l2_count(aratios2) - breaks) 
-                
-                # Change all splitters to breaks.
-                aratios2 = list_percentify(aratios2)
-                aratios2 = list_cumsum(aratios2)
-                aratios = list_rangify(aratios2)
-                aratios2r = list_percentify(aratios2r)
-                aratios2r = list_cumsum(aratios2r)
-                aratiosr = list_rangify(aratios2r)
-                bratios = bratios2 
-                
-                # Merge various L2s to cells and rows.
-                drows = []
-                for r,_ in enumerate(lbreaks):
-                    dcells = []
-                    for c,_ in enumerate(lbreaks[r]):
-                        d = RegionCell(aratios[r][c][0], aratios[r][c][1], bratios[r][c], lbreaks[r][c])
-                        dcells.append(d)
-                    drow = RegionRow(aratiosr[r][0], aratiosr[r][1], dcells)
-                    drows.append(drow)
-                self.aratios = drows
-                # Convert all keys to breaks, and expand neg to fit.
-                mainprompt = mainprompt.replace(KEYROW,KEYBRK) # Cont: Should be case insensitive.
-                mainprompt = mainprompt.replace(KEYCOL,KEYBRK)
-                p.prompt = mainprompt
-                if self.usebase:
-                    p.prompt = baseprompt + fspace(KEYBRK) + p.prompt 
-                p.all_prompts = [p.prompt] * len(p.all_prompts)
-                np = p.negative_prompt
-                np.replace(KEYROW,KEYBRK)
-                np.replace(KEYCOL,KEYBRK)
-                np = np.split(KEYBRK)
-                nbreaks = len(np) - 1
-                if breaks >= nbreaks: # Repeating the first neg as in orig code.
-                    np.extend([np[0]] * (breaks - nbreaks))
-                else: # Cut off the excess negs.
-                    np = np[0:breaks + 1]
-                for i ,n in enumerate(np):
-                    if n.isspace() or n =="":
-                        np[i] = ","
-                # p.negative_prompt = fspace(KEYBRK).join(np)
-                # p.all_negative_prompts = [p.negative_prompt] * len(p.all_negative_prompts)
-                if comprompt is not None : 
-                    p.prompt = comprompt + fspace(KEYBRK) + p.prompt
-                    for i in lange(p.all_prompts):
-                        p.all_prompts[i] = comprompt + fspace(KEYBRK) + p.all_prompts[i]
-                if comnegprompt is not None :
-                    p.negative_prompt = comnegprompt + fspace(KEYBRK) + p.negative_prompt
-                    for i in lange(p.all_negative_prompts):
-                        p.all_negative_prompts[i] = comnegprompt + fspace(KEYBRK) + p.all_negative_prompts[i]
-                self, p = commondealer(self, p, self.usecom, self.usencom)
-            else:
-                self, p = promptdealer(self, p, aratios, bratios, usebase, usecom, usencom)
-                self, p = commondealer(self, p, usecom, usencom)
-    
+            self, p = layoutdealer(self, p, lratios[0], bratios, usebase, usecom, usencom)
             self.pt, self.nt ,ppt,pnt, self.eq = tokendealer(p)
+            # Regions with the same chunk share a context, hires. prompts included in case they differ.
+            self.ptkeys = chunkkeys(p.all_prompts + getattr(p, "all_hr_prompts", []))
+            self.ntkeys = chunkkeys(p.all_negative_prompts + getattr(p, "all_hr_negative_prompts", []))
+            if not uniform:
+                self, p = sampledealer(self, p, samples, bratios, usebase, usecom, usencom)
 
             #self.eq = True if len(self.pt) == len(self.nt) else False
             
             if calcmode == "Attention":
+                # Region boundaries of every attention layer size, hires. fix pass included.
+                for layout in [self] + (self.layouts or []):
+                    for (height, width) in [(self.h, self.w)] + ([(self.hr_h, self.hr_w)] if self.hr else []):
+                        for level in range(4): # Latent is 1/8 of the image, halved by each down block.
+                            xs = repeat_div(height, 3 + level) * repeat_div(width, 3 + level)
+                            regionplan(layout, xs, *layer_hw(self, xs), devices.device)
+                self.ctxcache = {} # Token ranges may differ from the last run.
+                self.pn = True
+                self.cfgrows = None
+                if not hasattr(self,"dr_callbacks"):
+                    self.dr_callbacks = on_cfg_denoiser(self.denoiser_callback)
                 self.handle = hook_forwards(self, p.sd_model.model.diffusion_model)
                 shared.batch_cond_uncond = orig_batch_cond_uncond 
             else:
@@ -739,27 +1451,31 @@ class Script(modules.scripts.Script):
                 if not hasattr(self,"dr_callbacks"):
                     self.dr_callbacks = on_cfg_denoiser(self.denoiser_callback)
                 self.handle = hook_forwards(self, p.sd_model.model.diffusion_model,remove = True)
-                shared.batch_cond_uncond = False
+                # Batched LoRA regions take per row multipliers, so areas can share a U-Net pass.
+                shared.batch_cond_uncond = orig_batch_cond_uncond if self.batchlora else False
                 del self.handle
                 self, p = calcdealer(self, p,calcmode)
                 global regioner
                 regioner.reset()
                 regioner.divide = self.divide if not self.usebase else self.divide  +1
                 regioner.batch = p.batch_size
+                regioner.batched = self.batchlora
                 if self.debug : print(p.prompt)
 
             print(f"pos tokens : {ppt}, neg tokens : {pnt}")
             if debug : 
                 print(f"mode : {self.calcmode}\ndivide : {mode}\nusebase : {self.usebase}")
                 print(f"base ratios : {self.bratios}\nusecommon : {self.usecom}\nusenegcom : {self.usencom}\nuse 2D : {self.indexperiment}")
-                print(f"divide : {self.divide}\neq : {self.eq}\n")
+                print(f"divide : {self.divide}\neq : {self.eq}\nbatch regions : {self.batchregions}\ncrop regions : {self.cropregions}\nbackend : {self.backend}, slice size : {self.slicesize}\n")
                 print(f"ratios : {self.aratios}\n")
+                if self.layouts is not None : print(f"sample layouts : {len(self.layouts)}, of images : {self.layoutindex}\n")
+                print(f"token cache : {tokenstats[0]} hits, {tokenstats[1]} misses, {tokenstats[2]} whole prompt hits\n")
         else:
             unloader(self,p)
         return p
 
-    def process_batch(self, p, active, debug, mode, aratios, bratios, usebase, usecom, usencom, calcmode,nchangeand, lnter, lnur,**kwargs):
-        global lactive,labug
+    def process_batch(self, p, active, debug, mode, aratios, bratios, usebase, usecom, usencom, calcmode,nchangeand, lnter, lnur, batchregions, cropregions, backend, slicesize, onechannel, feather, lorabudget, batchlora, loravram, regionsteps, regionsigma, regionblocks, singleneg,**kwargs):
+        global lactive,labug,loralimit,loraindex,loraplacelimit
         if self.lora_applied: # SBM Don't override orig twice on batch calls.
             pass
         elif self.active and calcmode =="Latent":
@@ -774,9 +1490,8 @@ class Script(modules.scripts.Script):
                 torch.nn.Linear.forward = lora_Linear_forward
                 torch.nn.Conv2d.forward = lora_Conv2d_forward
 
-                for l in lora.loaded_loras:
-                    for key in l.modules.keys():
-                        changethedevice(l.modules[key])
+                loraplacelimit = int(floatdef(loravram, 0) * 2 ** 20)
+                placeloras(lora.loaded_loras)
                 restoremodel(p)
 
             elif hasattr(lora,"lora_forward"):
@@ -785,20 +1500,26 @@ class Script(modules.scripts.Script):
                 lora.lora_forward = lora_forward
             lactive = True
             labug = self.debug
+            loralimit = int(floatdef(lorabudget, 0) * 2 ** 20)
             self.lora_applied = True
             lora_namer(self, p, lnter, lnur)
         else:
             lactive = False
+        if lactive: # LoRAs are activated per batch, index them again.
+            loraindex = loraindexer()
+        if self.active and self.layouts is not None: # Layouts of the images of this batch.
+            start = kwargs.get("batch_number", 0) * self.batch_size
+            self.rowlayouts = tuple(self.layoutindex[start:start + self.batch_size])
 
 
     # TODO: Should remove usebase, usecom, usencom - grabbed from self value.
-    def postprocess_image(self, p, pp, active, debug, mode, aratios, bratios, usebase, usecom, usencom, calcmode, nchangeand, lnter, lnur):
+    def postprocess_image(self, p, pp, active, debug, mode, aratios, bratios, usebase, usecom, usencom, calcmode, nchangeand, lnter, lnur, batchregions, cropregions, backend, slicesize, onechannel, feather, lorabudget, batchlora, loravram, regionsteps, regionsigma, regionblocks, singleneg):
         if not self.active:
             return p
-        if self.usecom or self.indexperiment or self.anded:
+        if self.usecom or self.indexperiment or self.anded or self.layouts is not None:
             p.prompt = self.orig_all_prompts[0]
             p.all_prompts[self.imgcount] = self.orig_all_prompts[self.imgcount]
-        if self.usencom:
+        if self.usencom or self.layouts is not None:
             p.negative_prompt = self.orig_all_negative_prompts[0]
             p.all_negative_prompts[self.imgcount] = self.orig_all_negative_prompts[self.imgcount]
         self.imgcount += 1
@@ -819,6 +1540,7 @@ class Script(modules.scripts.Script):
         if orig_lora_apply_weights != None :
             lora.lora_apply_weights = orig_lora_apply_weights
             orig_lora_apply_weights = None
+            clearloracache(p)
 
         if orig_lora_forward != None :
             lora.lora_forward = orig_lora_forward
@@ -853,347 +1575,442 @@ class Script(modules.scripts.Script):
 # [Batch2-Area2, Batch2-Area3] -> [Batch1-Area3, Batch2-Area3] 
 
     def denoiser_callback(self, params: CFGDenoiserParams):
+        if self.active and self.calcmode == "Attention":
+            self.cfgrows = cfgsplit(params)
+            self.regionon = regionwindow(self, params.sampling_step, params.total_sampling_steps, params.sigma)
         if lactive:
-            xt = params.x.clone()
-            ict = params.image_cond.clone()
-            st =  params.sigma.clone()
+            regioner.row = 0 # U-Net passes of this step start over, see u_start.
+            areas = params.x.shape[0] // self.batch_size -1
+            n = areas * self.batch_size
+            order = areaorder(self, self.batch_size, areas, params.x.device)
+            # Indexing gathers into a new tensor, so no clones are needed.
+            params.x[:n] = params.x[:n][order]
+            params.image_cond[:n] = params.image_cond[:n][order]
+            params.sigma[:n] = params.sigma[:n][order]
             # SBM Stale version workaround.
             if hasattr(params,"text_cond"):
-                ct =  params.text_cond.clone()
-            areas = xt.shape[0] // self.batch_size -1
-
-            for a in range(areas):
-                for b in range(self.batch_size):
-                    params.x[b+a*self.batch_size] = xt[a + b * areas]
-                    params.image_cond[b+a*self.batch_size] = ict[a + b * areas]
-                    params.sigma[b+a*self.batch_size] = st[a + b * areas]
-                    # SBM Stale version workaround.
-                    if hasattr(params,"text_cond"):
-                        params.text_cond[b+a*self.batch_size] = ct[a + b * areas]
+                ct = params.text_cond
+                for t in (ct.values() if isinstance(ct, dict) else [ct]): # SDXL conds are a dict.
+                    t[:n] = t[:n][order]
 
     def denoised_callback(self, params: CFGDenoisedParams):
         if lactive:
             x = params.x
             batch = self.batch_size
             # x.shape = [batch_size, C, H // 8, W // 8]
-            if self.filters == [] :
-                self.filters = makefilters(x.shape[1], x.shape[2], x.shape[3],self.aratios,self.mode,self.usebase,self.bratios,self.indexperiment)
-                self.neg_filters = [1- f for f in self.filters]
+            areas = x.shape[0] // batch -1
+            n = areas * batch
+            if self.layouts is not None: # Per sample layouts, the filters of every image.
+                lfilters = [regionfilters(self.layouts[l], x) for l in self.rowlayouts]
+                filters = torch.stack([f[0][:areas] for f in lfilters])
+                neg_filters = torch.stack([f[1][:areas] for f in lfilters])
             else:
-                if self.filters[0].size() != x[0].size():
-                    self.filters = makefilters(x.shape[1], x.shape[2], x.shape[3],self.aratios,self.mode,self.usebase,self.bratios,self.indexperiment)
-                    self.neg_filters = [1- f for f in self.filters]
-
-            if self.debug : print("filterlength : ",len(self.filters))
-
-            x = params.x
-            xt = params.x.clone()
-
-            areas = xt.shape[0] // batch -1
+                filters, neg_filters = regionfilters(self, x)
+                if self.debug : print("filterlength : ",len(filters))
+                filters, neg_filters = filters[:areas], neg_filters[:areas]
 
             if labug : 
                 for i in range(params.x.shape[0]):
                     print(torch.max(params.x[i]))
 
-            for b in range(batch):
-                for a in range(areas):
-                    x[a + b * areas] = xt[b+a*batch]
+            # Area major [Batch1-Area1, Batch2-Area1, ...] back to batch major, see denoiser_callback.
+            order = areaorder(self, batch, areas, x.device, inverse = True)
+            xa = x[:n][order].view(batch, areas, *x.shape[1:])
+            # Uncond of each image fills outside its areas.
+            xu = x[x.shape[0] - batch:, None]
+            x[:n] = (xa * filters + xu * neg_filters).view(n, *x.shape[1:])
 
-            for b in range(batch):
-                for a in range(areas) :
-                    #print(f"x = {x.size()}f = {r}, b={b}, count = {r + b*areas}, uncon = {x.size()[0]+(b-batch)}")
-                    x[a + b*areas, :, :, :] =  x[a + b*areas, :, :, :] * self.filters[a] + x[x.size()[0]+(b-batch), :, :, :] * self.neg_filters[a]
+def areaorder(self, batch, areas, device, inverse = False):
+    """Index regrouping batch major [Batch1-Area1, Batch1-Area2, ...] rows to area major, cached per size.
+
+    Inverse gives the order back, used once the latents are denoised.
+    """
+    key = (batch, areas, device, inverse)
+    if key not in self.orders:
+        order = torch.arange(areas * batch, device = device)
+        if inverse:
+            order = order.view(areas, batch).t()
+        else:
+            order = order.view(batch, areas).t()
+        self.orders[key] = order.reshape(-1)
+    return self.orders[key]
 
 ################################################################################
 ##### Attention mode 
 
-def hook_forward(self, module):
+class HookContext():
+    """State read by the installed hooks. The script is swapped per job instead of hooking again."""
+    def __init__(self):
+        self.script = None
+
+hookcontext = HookContext()
+
+def regionwindow(self, step, steps, sigma):
+    """Whether regions are split at this step, per the region steps and min sigma options.
+
+    Steps up to 1 are fractions of the sampling steps, larger ones are step numbers, so 1 is the last step, not step 1.
+    Only called by denoiser_callback, DDIM / PLMS / UniPC don't call it and use regions on every step.
+    """
+    st, ed = [v * steps if v <= 1 else v for v in self.regionsteps]
+    if not st <= step < ed:
+        return False
+    return self.regionsigma <= 0 or sigma.max().item() >= self.regionsigma
+
+def blockfilter(text):
+    """Levels and layer name patterns of the region blocks option, None when all blocks are used."""
+    entries = [e.strip() for e in text.split(",") if e.strip()]
+    if not entries:
+        return None
+    return frozenset(int(e) for e in entries if e.isdigit()), tuple(e for e in entries if not e.isdigit())
+
+def regionblock(self, module, xs):
+    """Whether a layer splits regions, per the region blocks option.
+
+    Levels count halvings of the latent: 0 is 1/8 of the image, 1 is 1/16, up to 3 (middle block).
+    Patterns are matched to the LoRA layer name, eg *output_blocks*.
+    """
+    if self.blocks is None:
+        return True
+    hit = self.blockhits.get(module)
+    if hit is None:
+        levels, patterns = self.blocks
+        height, width = layer_hw(self, xs)
+        level = math.ceil(math.log2(math.sqrt(height * width / xs))) - 3 # As in split_dims.
+        name = getattr(module, "lora_layer_name", "")
+        hit = level in levels or any(fnmatch.fnmatchcase(name, pt) for pt in patterns)
+        self.blockhits[module] = hit
+    return hit
+
+def hook_forward(hctx, module):
     def forward(x, context=None, mask=None):
+        self = hctx.script
+        if not self.regionon: # Outside the region steps, all prompts in one pass as in webui.
+            return module.__class__.forward(module, x, context=context, mask=mask)
         if self.debug :
             print("input : ", x.size())
             print("tokens : ", context.size())
             print("module : ", module.lora_layer_name)
 
-        height = self.h
-        width = self.w
-
-        def hr_cheker(n):
-            return (n != 0) and (n & (n - 1) == 0)
-
-        if not hr_cheker(height * width // x.size()[1]) and self.hr:
-            height = self.hr_h
-            width = self.hr_w
-
-        sumer = 0
-        h_states = []
-        contexts = context.clone()
-        # SBM Matrix mode.
-        def matsepcalc(x,contexts,mask,pn,divide):
-            xs = x.size()[1]
-            (dsh,dsw) = split_dims(xs, height, width, debug = self.debug)
-            
-            if "Horizontal" in self.mode: # Map columns / rows first to outer / inner.
-                dsout = dsw
-                dsin = dsh
-            elif "Vertical" in self.mode:
-                dsout = dsh
-                dsin = dsw
-
-            tll = self.pt if pn else self.nt
-            
-            # Base forward.
-            cad = 0 if self.usebase else 1 # 1 * self.usebase is shorter.
-            i = 0
+        height, width = layer_hw(self, x.size()[1])
+
+        contexts = context
+
+        def regionforward(x, q, context, mask, divide, shape, crop, full, g):
+            """Forward one region and return only the tokens inside crop.
+
+            Shape is the token layout the crop indexes, eg (dsh, dsw) or (xs,).
+            In crop mode the query is cut first, so attention skips discarded rows.
+            Otherwise the whole output is kept in full by group g, regions with the same context share it.
+            """
+            crop = (slice(None),) + crop
+            if self.cropregions:
+                qc = q.reshape(q.size()[0], *shape, q.size()[-1])[crop]
+                out = main_forward(module, x, context, mask, divide, self.isvanilla,
+                                   qc.reshape(q.size()[0], -1, q.size()[-1]), self.backend, self.slicesize)
+                return out.reshape(out.size()[0], *qc.size()[1:-1], out.size()[-1])
+            out = full.get(g)
+            if out is None:
+                out = main_forward(module, x, context, mask, divide, self.isvanilla, q, self.backend, self.slicesize)
+                out = out.reshape(out.size()[0], *shape, out.size()[-1])
+                full[g] = out
+            return out[crop]
+
+        def batchedcalc(x, q, lctx, plan, mask, divide, ukeys):
+            """All regions in one attention call, then a single gather. Mask is a list, one per region.
+
+            Regions sharing a context are forwarded once, skipped regions (see regiongroups) not at all.
+            """
+            first, gmap, index, slots, pos = plan.regiongroups(ukeys, self.usebase)
+            usebase = self.usebase and gmap[0] >= 0
+            if self.cropregions and plan.soft is None: # Feathered regions overlap, no single owner.
+                ox = None
+                if slots is not None:
+                    ox = main_forward_cropped(module, x, [lctx[r] for r in first], slots, pos, [mask[r] for r in first],
+                                              divide, self.isvanilla, q, self.backend, self.slicesize)
+                if usebase:
+                    outb = main_forward(module, x, lctx[0], mask[0], divide, self.isvanilla, q, self.backend, self.slicesize)
+                    ox = outb if ox is None else torch.lerp(ox, outb, plan.weights(ox.dtype))
+                return ox
+            outs = main_forward_batched(module, x, [lctx[r] for r in first], [mask[r] for r in first],
+                                        divide, self.isvanilla, q, self.backend, self.slicesize)
+            if len(first) < len(gmap):
+                outs = outs[index]
+            return regioncomposite(outs, plan, usebase)
+
+        def sepcalc(x, q, lctx, lmask, plan, divide, ukeys):
+            """Regions one by one, written straight into the layer, then the base blended over it at once."""
+            first, gmap, _, _, _ = plan.regiongroups(ukeys, self.usebase)
             outb = None
-            if self.usebase:
-                context = contexts[:,tll[i][0] * TOKENSCON:tll[i][1] * TOKENSCON,:]
-                # SBM Controlnet sends extra conds at the end of context, apply it to all regions.
-                cnet_ext = contexts.shape[1] - (contexts.shape[1] // TOKENSCON) * TOKENSCON
-                if cnet_ext > 0:
-                    context = torch.cat([context,contexts[:,-cnet_ext:,:]],dim = 1)
-                    
-                i = i + 1 + self.basebreak
-                out = main_forward(module, x, context, mask, divide, self.isvanilla)
-
-                if len(self.nt) == 1 and not pn:
-                    if self.debug : print("return out for NP")
-                    return out
-                # if self.usebase:
-                outb = out.clone()
-                outb = outb.reshape(outb.size()[0], dsh, dsw, outb.size()[2]) 
-
-            sumout = 0
-
-            if self.debug : print(f"tokens : {tll},pn : {pn}")
-            if self.debug : print([r for r in self.aratios])
-
-            for drow in self.aratios:
-                v_states = []
-                sumin = 0
-                for dcell in drow.cols:
-                    # Grabs a set of tokens depending on number of unrelated breaks.
-                    context = contexts[:,tll[i][0] * TOKENSCON:tll[i][1] * TOKENSCON,:]
-                    # SBM Controlnet sends extra conds at the end of context, apply it to all regions.
-                    cnet_ext = contexts.shape[1] - (contexts.shape[1] // TOKENSCON) * TOKENSCON
-                    if cnet_ext > 0:
-                        context = torch.cat([context,contexts[:,-cnet_ext:,:]],dim = 1)
-                        
-                    if self.debug : print(f"tokens : {tll[i][0]*TOKENSCON}-{tll[i][1]*TOKENSCON}")
-                    i = i + 1 + dcell.breaks
-                    # if i >= contexts.size()[1]: 
-                    #     indlast = True
-                    out = main_forward(module, x, context, mask, divide, self.isvanilla)
-                    if self.debug : print(f" dcell.breaks : {dcell.breaks}, dcell.ed : {dcell.ed}, dcell.st : {dcell.st}")
-                    if len(self.nt) == 1 and not pn:
-                        if self.debug : print("return out for NP")
-                        return out
-                    # Actual matrix split by region.
-                    
-                    out = out.reshape(out.size()[0], dsh, dsw, out.size()[2]) # convert to main shape.
-                    # if indlast:
-                    addout = 0
-                    addin = 0
-                    sumin = sumin + int(dsin*dcell.ed) - int(dsin*dcell.st)
-                    if dcell.ed >= 0.999:
-                        addin = sumin - dsin
-                        sumout = sumout + int(dsout*drow.ed) - int(dsout*drow.st)
-                        if drow.ed >= 0.999:
-                            addout = sumout - dsout
-                    if "Horizontal" in self.mode:
-                        out = out[:,int(dsh*drow.st) + addout:int(dsh*drow.ed),
-                                    int(dsw*dcell.st) + addin:int(dsw*dcell.ed),:]
-                        if self.usebase : 
-                            # outb_t = outb[:,:,int(dsw*drow.st):int(dsw*drow.ed),:].clone()
-                            outb_t = outb[:,int(dsh*drow.st) + addout:int(dsh*drow.ed),
-                                            int(dsw*dcell.st) + addin:int(dsw*dcell.ed),:].clone()
-                            out = out * (1 - dcell.base) + outb_t * dcell.base
-                    elif "Vertical" in self.mode: # Cols are the outer list, rows are cells.
-                        out = out[:,int(dsh*dcell.st) + addin:int(dsh*dcell.ed),
-                                  int(dsw*drow.st) + addout:int(dsw*drow.ed),:]
-                        if self.usebase : 
-                            # outb_t = outb[:,:,int(dsw*drow.st):int(dsw*drow.ed),:].clone()
-                            outb_t = outb[:,int(dsh*dcell.st) + addin:int(dsh*dcell.ed),
-                                          int(dsw*drow.st) + addout:int(dsw*drow.ed),:].clone()
-                            out = out * (1 - dcell.base) + outb_t * dcell.base
-                    if self.debug : print(f"sumin:{sumin},sumout:{sumout},dsh:{dsh},dsw:{dsw}")
-            
-                    v_states.append(out)
-                    if self.debug : 
-                        for h in v_states:
-                            print(h.size())
-                            
-                if "Horizontal" in self.mode:
-                    ox = torch.cat(v_states,dim = 2) # First concat the cells to rows.
-                elif "Vertical" in self.mode:
-                    ox = torch.cat(v_states,dim = 1) # Cols first mode, concat to cols.
-                h_states.append(ox)
-            if "Horizontal" in self.mode:
-                ox = torch.cat(h_states,dim = 1) # Second, concat rows to layer.
-            elif "Vertical" in self.mode:
-                ox = torch.cat(h_states,dim = 2) # Or cols.
-            ox = ox.reshape(x.size()[0],x.size()[1],x.size()[2]) # Restore to 3d source.  
+            if self.usebase and gmap[0] >= 0:
+                outb = main_forward(module, x, lctx[0], lmask[0], divide, self.isvanilla, q, self.backend, self.slicesize)
+            ox = None
+            full = {} # Whole region outputs by group, without crop mode.
+            for r in range(int(self.usebase), len(gmap)):
+                if gmap[r] < 0:
+                    continue
+                out = regionforward(x, q, lctx[r], lmask[r], divide, plan.shape, plan.crops[r], full, gmap[r])
+                if self.debug : print(f"region {r} : {out.size()}")
+                if ox is None:
+                    ox = out.new_zeros(x.size()[0], x.size()[1], out.size()[-1])
+                regionwrite(ox, out, plan, r)
+            if outb is not None: # Base blended over the whole layer at once, per region weights.
+                ox = outb if ox is None else torch.lerp(ox, outb, plan.weights(ox.dtype))
             return ox
 
-        def regsepcalc(x, contexts, mask, pn,divide):
-            sumer = 0
-            h_states = []
-
-            tll = self.pt if pn else self.nt
-            if self.debug : print(f"tokens : {tll},pn : {pn}")
-
-            for i, tl in enumerate(tll):
-                context = contexts[:, tl[0] * TOKENSCON : tl[1] * TOKENSCON, :]
-                # SBM Controlnet sends extra conds at the end of context, apply it to all regions.
-                cnet_ext = contexts.shape[1] - (contexts.shape[1] // TOKENSCON) * TOKENSCON
-                if cnet_ext > 0:
-                    context = torch.cat([context,contexts[:,-cnet_ext:,:]],dim = 1)
-                
-                if self.debug : print(f"tokens : {tl[0]*TOKENSCON}-{tl[1]*TOKENSCON}")
+        # SBM Matrix mode.
+        def matsepcalc(x,lctx,lmask,divide,ukeys):
+            plan = regionplan(self, x.size()[1], height, width, x.device)
+            q = query_forward(module, x, divide, self.isvanilla)
+            if self.debug : print([r for r in self.aratios])
 
-                if self.usebase:
-                    if i != 0:
-                        area = self.aratios[i - 1]
-                        bweight = self.bratios[i - 1]
+            if self.batchregions:
+                return batchedcalc(x, q, lctx, plan, lmask, divide, ukeys)
+            return sepcalc(x, q, lctx, lmask, plan, divide, ukeys)
+
+        def regsepcalc(x, lctx, lmask, divide, ukeys):
+            plan = regionplan(self, x.size()[1], height, width, x.device)
+            q = query_forward(module, x, divide, self.isvanilla)
+
+            if self.batchregions:
+                return batchedcalc(x, q, lctx, plan, lmask, divide, ukeys)
+            return sepcalc(x, q, lctx, lmask, plan, divide, ukeys)
+
+        if module is self.passmodule: # First layer of a UNet pass.
+            unetpass(self, x)
+        if not regionblock(self, module, x.size()[1]): # All prompts in one pass as in webui.
+            return module.__class__.forward(module, x, context=context, mask=mask)
+        def regionpass(x, contexts, mask, roles, divide):
+            # Grabs a set of tokens per region depending on number of unrelated breaks.
+            lctx, lmask, ukeys = regioncontexts(self, contexts, roles)
+            lmask = [mask if m is None else m for m in lmask]
+
+            if roles is False and len(self.nt) == 1:
+                # Single negative, the first context (base or region) is applied everywhere.
+                if self.debug : print("return out for NP")
+                return main_forward(module, x, lctx[0], mask, divide, self.isvanilla, None, self.backend, self.slicesize)
+            elif self.indexperiment:
+                return matsepcalc(x, lctx, lmask, divide, ukeys)
+            return regsepcalc(x, lctx, lmask, divide, ukeys)
+
+        def rolepass(x, contexts, mask, roles, divide):
+            # Cond rows keep the divide they have without the single negative, 1 with equal lengths (see unetpass), else the pass's.
+            cdivide = 1 if self.eq else divide
+            if self.singleneg and roles is not True:
+                # Uncond rows take the whole negative in one pass as in webui, cond rows (first or last) the regions.
+                if roles is False:
+                    return module.__class__.forward(module, x, context=contexts, mask=mask)
+                k = roles.index(roles[-1])
+                if all(r == roles[-1] for r in roles[k:]):
+                    outs = []
+                    for rows, role in ((slice(0, k), roles[0]), (slice(k, None), roles[-1])):
+                        rmask = mask if mask is None else mask[rows]
+                        if role:
+                            outs.append(regionpass(x[rows], contexts[rows], rmask, True, cdivide))
+                        else:
+                            outs.append(module.__class__.forward(module, x[rows], context=contexts[rows], mask=rmask))
+                    return torch.cat(outs)
+            if roles is True: # Cond rows alone, some from a mixed pass when split by layout.
+                return regionpass(x, contexts, mask, True, cdivide)
+            return regionpass(x, contexts, mask, roles, divide)
+
+        roles = self.roles
+        # SBM A pass mixing cond and uncond used to be forwarded as 2 halves with divide 2, kept for the same results.
+        divide = 1 if isinstance(roles, bool) else 2
+        if self.debug : print(f"tokens : {self.pt if roles is True else self.nt if roles is False else (self.pt, self.nt)}, roles : {roles}")
+        if self.layouts is not None: # Per sample layouts, runs of rows sharing one are forwarded together.
+            script = self
+            outs = []
+            for st, ed, l in script.layoutruns:
+                # The helpers read self when called, rebinding it switches them to the layout.
+                self = script.layouts[l]
+                if self.eq and not self.singleneg: # As its image alone, see unetpass.
+                    rroles, rdivide = True, 1
                 else:
-                    area = self.aratios[i]
-
-                out = main_forward(module, x, context, mask, divide, self.isvanilla)
-
-                if len(self.nt) == 1 and not pn:
-                    if self.debug : print("return out for NP")
-                    return out
-
-                xs = x.size()[1]
-                scale = round(math.sqrt(height * width / xs))
-
-                dsh = round(height / scale)
-                dsw = round(width / scale)
-                ha, wa = xs % dsh, xs % dsw
-                if ha == 0:
-                    dsw = int(xs / dsh)
-                elif wa == 0:
-                    dsh = int(xs / dsw)
-
-                if self.debug : print(scale, dsh, dsw, dsh * dsw, x.size()[1])
-
-                if i == 0 and self.usebase:
-                    outb = out.clone()
-                    if "Horizontal" in self.mode:
-                        outb = outb.reshape(outb.size()[0], dsh, dsw, outb.size()[2])
-                    continue
-                add = 0
-
-                cad = 0 if self.usebase else 1
-
-                if "Horizontal" in self.mode:
-                    sumer = sumer + int(dsw * area[1]) - int(dsw * area[0])
-                    if i == self.divide - cad:
-                        add = sumer - dsw
-                    out = out.reshape(out.size()[0], dsh, dsw, out.size()[2])
-                    out = out[:, :, int(dsw * area[0] + add) : int(dsw * area[1]), :]
-                    if self.debug : print(f"sumer:{sumer},dsw:{dsw},add:{add}")
-                    if self.usebase:
-                        outb_t = outb[:, :, int(dsw * area[0] + add) : int(dsw * area[1]), :].clone()
-                        out = out * (1 - bweight) + outb_t * bweight
-                elif "Vertical" in self.mode:
-                    sumer = sumer + int(dsw * dsh * area[1]) - int(dsw * dsh * area[0])
-                    if i == self.divide - cad:
-                        add = sumer - dsw * dsh
-                    out = out[:, int(dsw * dsh * area[0] + add) : int(dsw * dsh * area[1]), :]
-                    if self.debug : print(f"sumer:{sumer},dsw*dsh:{dsw*dsh},add:{add}")
-                    if self.usebase:
-                        outb_t = outb[:,int(dsw * dsh * area[0] + add) : int(dsw * dsh * area[1]),:,].clone()
-                        out = out * (1 - bweight) + outb_t * bweight
-                h_states.append(out)
-            if self.debug:
-                for h in h_states :
-                    print(f"divided : {h.size()}")
-
-            if "Horizontal" in self.mode:
-                ox = torch.cat(h_states, dim=2)
-                ox = ox.reshape(x.size()[0], x.size()[1], x.size()[2])
-            elif "Vertical" in self.mode:
-                ox = torch.cat(h_states, dim=1)
-            return ox
-
-        if self.eq:
-            if self.debug : print("same token size and divisions")
-            if self.indexperiment:
-                ox = matsepcalc(x, contexts, mask, True, 1)
-            else:
-                ox = regsepcalc(x, contexts, mask, True, 1)
-        elif x.size()[0] == 1 * self.batch_size:
-            if self.debug : print("different tokens size")
-            if self.indexperiment:
-                ox = matsepcalc(x, contexts, mask, self.pn, 1)
-            else:
-                ox = regsepcalc(x, contexts, mask, self.pn, 1)
+                    rroles = roles if isinstance(roles, bool) else roles[st:ed]
+                    if not isinstance(rroles, bool) and len(set(rroles)) == 1:
+                        rroles = rroles[0]
+                    # Alone, its cond and uncond rows share a pass just when this one mixes them.
+                    # Cond rows of an eq layout still take divide 1 in rolepass, as without the single negative.
+                    rdivide = divide
+                outs.append(rolepass(x[st:ed], contexts[st:ed], mask if mask is None else mask[st:ed], rroles, rdivide))
+            self = script
+            ox = torch.cat(outs) if len(outs) > 1 else outs[0]
         else:
-            if self.debug : print("same token size and different divisions")
-            # SBM You get 2 layers of x, context for pos/neg.
-            # Each should be forwarded separately, pairing them up together.
-            if self.isvanilla: # SBM Ddim reverses cond/uncond.
-                nx, px = x.chunk(2)
-                conn,conp = contexts.chunk(2)
-            else:
-                px, nx = x.chunk(2)
-                conp,conn = contexts.chunk(2)
-            if self.indexperiment:
-                # SBM I think division may have been an incorrect patch.
-                # But I'm not sure, haven't tested beyond DDIM / PLMS.
-                opx = matsepcalc(px, conp, mask, True, 2)
-                onx = matsepcalc(nx, conn, mask, False, 2)
-                # opx = matsepcalc(px, contexts, mask, True, 2)
-                # onx = matsepcalc(nx, contexts, mask, False, 2)
-            else:
-                opx = regsepcalc(px, conp, mask, True, 2)
-                onx = regsepcalc(nx, conn, mask, False, 2)
-                # opx = regsepcalc(px, contexts, mask, True, 2)
-                # onx = regsepcalc(nx, contexts, mask, False, 2)
-            if self.isvanilla: # SBM Ddim reverses cond/uncond.
-                ox = torch.cat([onx, opx])
-            else:
-                ox = torch.cat([opx, onx])  
+            ox = rolepass(x, contexts, mask, roles, divide)
 
-        self.count += 1
-
-        if self.count == 16:
-            self.pn = not self.pn
-            self.count = 0
         if self.debug : print(f"output : {ox.size()}")
         return ox
 
     return forward
 
+def attn2layers(root_module):
+    """Cross attention layers of a model, looked up once and kept on the model."""
+    layers = getattr(root_module, "rp_attn2layers", None)
+    if layers is None:
+        layers = [module for name, module in root_module.named_modules()
+                  if "attn2" in name and module.__class__.__name__ == "CrossAttention"]
+        root_module.rp_attn2layers = layers
+    return layers
+
 def hook_forwards(self, root_module: torch.nn.Module, remove=False):
-    for name, module in root_module.named_modules():
-        if "attn2" in name and module.__class__.__name__ == "CrossAttention":
-            module.forward = hook_forward(self, module)
-            if remove:
+    hookcontext.script = self
+    layers = attn2layers(root_module)
+    self.passmodule = layers[0] if layers else None # Marks the start of every UNet pass.
+    for module in layers:
+        if remove:
+            if "forward" in module.__dict__:
                 del module.forward
+            continue
+        # Hooks are made once per layer, and again when this script was reloaded since they read its old context.
+        if module.__dict__.get("rp_hookcontext") is not hookcontext:
+            module.rp_forward = hook_forward(hookcontext, module)
+            module.rp_hookcontext = hookcontext
+        module.forward = module.rp_forward
 
 ############################################################
 ##### prompts, tokens
 
+def cacheput(cache, key, value, limit):
+    """Adds to an LRU dict, dropping the oldest entries past limit."""
+    cache[key] = value
+    while len(cache) > limit:
+        cache.popitem(last=False)
+
+def tokencount(model, chunk):
+    """Token count of a prompt chunk, cached per model and tokenizer setting."""
+    key = (model, chunk)
+    tokens = tokencache.get(key)
+    if tokens is None:
+        tokenstats[1] += 1
+        _, tokens = shared.sd_model.cond_stage_model.tokenize_line(chunk)
+        cacheput(tokencache, key, tokens, TOKENCACHE)
+    else:
+        tokenstats[0] += 1
+        tokencache.move_to_end(key)
+    return tokens
+
+def layoutdealer(self, p, aratios, bratios, usebase, usecom, usencom):
+    """Regions of p.prompt and its ratios, with the region prompts written back to p.
+
+    Also run for every distinct image of a job on a holder of its prompts, see sampledealer.
+    """
+    layout = parselayout(p.prompt, aratios, bratios, self.mode, usebase, usecom)
+    comprompt = comnegprompt = None
+    self.indexperiment = layout.indexperiment
+    self.usebase = usebase
+    self.usecom = layout.usecom
+    self.usencom = usencom
+    ntexts, nkeys, nraws, nfound = layouttokens(p.negative_prompt)
+    if KEYCOMM in nfound: # Automatic common toggle.
+        self.usencom = True
+
+    # SBM In matrix mode, the ratios are broken up 
+    if self.indexperiment:
+        comprompt = layout.comprompt
+        if self.usencom:
+            i = commoncut(nkeys)
+            if i is not None:
+                comnegprompt = tokenjoin(ntexts, nraws, 0, i + 1)
+                p.negative_prompt = tokenjoin(ntexts, nraws, i + 1, len(ntexts))
+        self.usebase = layout.usebase
+        self.basebreak = layout.basebreak
+        self.aratios = layout.rows
+        p.prompt = layout.prompt
+        p.all_prompts = [p.prompt] * len(p.all_prompts)
+        if comprompt is not None : 
+            p.prompt = comprompt + fspace(KEYBRK) + p.prompt
+            for i in lange(p.all_prompts):
+                p.all_prompts[i] = comprompt + fspace(KEYBRK) + p.all_prompts[i]
+        if comnegprompt is not None :
+            p.negative_prompt = comnegprompt + fspace(KEYBRK) + p.negative_prompt
+            for i in lange(p.all_negative_prompts):
+                p.all_negative_prompts[i] = comnegprompt + fspace(KEYBRK) + p.all_negative_prompts[i]
+        self, p = commondealer(self, p, self.usecom, self.usencom)
+    else:
+        self, p = promptdealer(self, p, aratios, bratios, usebase, usecom, usencom)
+        self, p = commondealer(self, p, usecom, usencom)
+    return self, p
+
+def sampledealer(self, p, samples, bratios, usebase, usecom, usencom):
+    """Layouts of the images of a job whose prompts or ratios differ.
+
+    Samples holds the prompt, negative and ratios of every image. Every distinct one gets a copy of the script
+    with its own regions, token spans and region plans, the hooks switch to it for the rows of its images.
+    Sets self.layouts and self.layoutindex, the layout of every image, and writes the region prompts to p.
+    """
+    index = {}
+    layouts = []
+    prompts = []
+    for sample in samples:
+        if sample in index:
+            continue
+        prompt, negative, aratios = sample
+        layout = copy.copy(self) # Settings are shared, the layout is replaced.
+        layout.all_prompts, layout.all_negative_prompts = [], []
+        layout.plans, layout.ctxcache = {}, {}
+        q = SimpleNamespace(prompt = prompt, negative_prompt = negative,
+                            all_prompts = [prompt], all_negative_prompts = [negative])
+        layout, q = layoutdealer(layout, q, aratios, bratios, usebase, usecom, usencom)
+        layout.pt, layout.nt, _, _, layout.eq = tokendealer(q)
+        index[sample] = len(layouts)
+        layouts.append(layout)
+        prompts.append((q.prompt, q.negative_prompt))
+    if self.calcmode == "Latent" and len(set(len(layout.pt) for layout in layouts)) > 1:
+        # Every image takes the same number of area rows, see denoiser_callback.
+        print("Warning: Latent mode needs the same number of regions in every prompt, using one layout.")
+        return self, p
+    self.layouts = layouts
+    self.layoutindex = [index[sample] for sample in samples]
+    # Hires. prompts of the images included in case they differ, as for a single layout.
+    hrprompts = getattr(p, "all_hr_prompts", [])
+    hrnegatives = getattr(p, "all_hr_negative_prompts", [])
+    for l, layout in enumerate(layouts):
+        images = [i for i, li in enumerate(self.layoutindex) if li == l]
+        layout.ptkeys = chunkkeys([prompts[l][0]] + [hrprompts[i] for i in images if i < len(hrprompts)])
+        layout.ntkeys = chunkkeys([prompts[l][1]] + [hrnegatives[i] for i in images if i < len(hrnegatives)])
+    self.rowlayouts = tuple(self.layoutindex[:self.batch_size])
+    self.eq = all(layout.eq for layout in layouts)
+    for i, l in enumerate(self.layoutindex):
+        p.all_prompts[i], p.all_negative_prompts[i] = prompts[l]
+    return self, p
+
+def embeddingstate():
+    """Hash of the loaded textual inversion embeddings and their vector counts, None without a database."""
+    db = getattr(getattr(sd_hijack, "model_hijack", None), "embedding_db", None)
+    if db is None:
+        return None
+    return hash(tuple(sorted((name, getattr(e, "vectors", 0)) for name, e in db.word_embeddings.items())))
+
 def tokendealer(p):
+    # Token counts depend on the checkpoint, comma backtracking and the embeddings a chunk may name.
+    model = (getattr(shared.sd_model, "sd_model_hash", None) or id(shared.sd_model),
+             getattr(shared.opts, "comma_padding_backtrack", None), embeddingstate())
+    key = (model, p.prompt, p.negative_prompt)
+    if key in spancache:
+        tokenstats[2] += 1
+        spancache.move_to_end(key)
+        pt, nt, ppt, pnt, eq = spancache[key]
+        return [t[:] for t in pt], [t[:] for t in nt], ppt[:], pnt[:], eq
+
     ppl = p.prompt.split(KEYBRK)
     npl = p.negative_prompt.split(KEYBRK)
     pt, nt, ppt, pnt = [], [], [], []
 
     padd = 0
     for pp in ppl:
-        _, tokens = shared.sd_model.cond_stage_model.tokenize_line(pp)
+        tokens = tokencount(model, pp)
         pt.append([padd, tokens // TOKENS + 1 + padd])
         ppt.append(tokens)
         padd = tokens // TOKENS + 1 + padd
     paddp = padd
     padd = 0
     for np in npl:
-        _, tokens = shared.sd_model.cond_stage_model.tokenize_line(np)
+        tokens = tokencount(model, np)
         nt.append([padd, tokens // TOKENS + 1 + padd])
         pnt.append(tokens)
         padd = tokens // TOKENS + 1 + padd
     eq = paddp == padd
+    cacheput(spancache, key, ([t[:] for t in pt], [t[:] for t in nt], ppt[:], pnt[:], eq), SPANCACHE)
     return pt, nt, ppt, pnt, eq
 
 def promptdealer(self, p, aratios, bratios, usebase, usecom, usencom):
@@ -1271,6 +2088,7 @@ def unloader(self,p):
         hook_forwards(self, p.sd_model.model.diffusion_model, remove=True)
         del self.handle
         shared.batch_cond_uncond = orig_batch_cond_uncond 
+    self.ctxcache = {}
     global lactive
     lactive = False
     self.active = False
@@ -1426,6 +2244,49 @@ def makefilters(c,h,w,masks,mode,usebase,bratios,xy):
 
     return filters
 
+def softfilters(c,h,w,masks,mode,usebase,bratios,xy,feather):
+    """Feathered counterpart of makefilters, stacked. Uses the same weight maps as Attention mode."""
+    if xy:
+        bases = [dcell.base for drow in masks for dcell in drow.cols]
+    else: # Paired with the base ratios as in makefilters.
+        masks = masks[:len(bratios)]
+        bases = list(bratios[:len(masks)])
+    rects = regionrects(masks, mode, xy, usebase)
+    soft = softmaps(rects, h, w, feather / (h * ATTNSCALE), feather / (w * ATTNSCALE), devices.device)
+    if usebase:
+        bases = torch.tensor([0] + bases, dtype = soft.dtype, device = soft.device)[:, None]
+        base = (soft * bases).sum(0)
+        soft = soft * (1 - bases) # Regions keep what the base leaves over.
+        soft[0] = base
+    return soft.reshape(-1, 1, h, w).expand(-1, c, -1, -1).contiguous()
+
+def filterlayout(aratios, bratios, xy):
+    """Hashable region layout, part of the latent mask cache key."""
+    if xy:
+        return tuple((drow.st, drow.ed, tuple((dcell.st, dcell.ed, dcell.base) for dcell in drow.cols)) for drow in aratios)
+    return tuple(tuple(mask) for mask in aratios), tuple(bratios)
+
+def regionfilters(self, x):
+    """Stacked (areas, c, h, w) latent masks and their complements in the dtype / device of x.
+
+    Cached per size and layout, so hires. fix and later jobs with the same layout reuse them.
+    With one channel masks c is 1, they broadcast over the latent channels.
+    """
+    c = 1 if self.onechannel else x.shape[1]
+    key = (c, x.shape[2], x.shape[3], self.mode, filterlayout(self.aratios, self.bratios, self.indexperiment),
+           self.usebase, self.feather, x.dtype, x.device)
+    entry = filtercache.get(key)
+    if entry is None:
+        if len(filtercache) >= FILTERCACHE:
+            filtercache.clear()
+        if self.feather > 0:
+            filters = softfilters(c, x.shape[2], x.shape[3],self.aratios,self.mode,self.usebase,self.bratios,self.indexperiment,self.feather)
+        else:
+            filters = torch.stack(makefilters(c, x.shape[2], x.shape[3],self.aratios,self.mode,self.usebase,self.bratios,self.indexperiment))
+        entry = (filters.to(x.device, x.dtype), (1 - filters).to(x.device, x.dtype))
+        filtercache[key] = entry
+    return entry
+
 ######################################################
 ##### Latent Method LoRA changer
 
@@ -1440,6 +2301,11 @@ class LoRARegioner:
         self.te_llist = [{}]
         self.u_llist = [{}]
         self.mlist = {}
+        self.batch = 1
+        self.batched = False
+        self.row = 0
+        self.mults = None
+        self.lmults = {}
 
     def ndeleter(self, lnter, lnur):
         for key in self.te_llist[0].keys():
@@ -1454,7 +2320,11 @@ class LoRARegioner:
         for i in range(len(lora.loaded_loras)):
             lora.loaded_loras[i].multiplier = self.mlist[lora.loaded_loras[i].name]
 
-    def u_start(self):
+    def u_start(self, n = None):
+        if self.batched and n is not None:
+            self.mults = self.rowmults(self.row, n)
+            self.row += n
+            return
         if labug : print("u_count",self.u_count ,"divide",{self.divide},"u_count '%' divide",  self.u_count % len(self.u_llist))
         self.mlist = self.u_llist[self.u_count % len(self.u_llist)]
         self.u_count  += 1
@@ -1462,13 +2332,55 @@ class LoRARegioner:
         for i in range(len(lora.loaded_loras)):
             lora.loaded_loras[i].multiplier = self.mlist[lora.loaded_loras[i].name]
     
+    def rowmults(self, row, n):
+        """Multipliers of every loaded LoRA for the n rows of a U-Net pass starting at row, None if all 0.
+
+        Rows are area major (see denoiser_callback), the uncond rows last take the negative multipliers.
+        """
+        key = (row, n)
+        if key not in self.lmults:
+            import lora
+            areas = [min(r // self.batch, len(self.u_llist) - 1) for r in range(row, row + n)]
+            lmults = []
+            for l in lora.loaded_loras:
+                mults = [self.u_llist[a][l.name] for a in areas]
+                lmults.append(torch.tensor(mults, device = devices.device) if any(mults) else None)
+            self.lmults[key] = lmults
+        return self.lmults[key]
+
     def reset(self):
         self.te_count = 0
         self.u_count = 0
+        self.row = 0
+        self.mults = None
+        self.lmults = {}
     
 regioner = LoRARegioner()
 
 
+def loraindexer():
+    """Index the modules of the loaded LoRAs by layer name, for lora_forward.
+
+    Each layer maps to ((lora index, forward, alpha scale, apply to outputs, U-Net layer), ...) in load order.
+    """
+    import lora
+    tooutputs = getattr(shared.opts, "lora_apply_to_outputs", False)
+    index = {}
+    for i, lora_m in enumerate(lora.loaded_loras):
+        for name, module in lora_m.modules.items():
+            if hasattr(module, 'up'):
+                alpha = module.alpha / module.up.weight.size(1) if module.alpha else 1.0
+            else:
+                alpha = module.alpha / module.dim if module.alpha else 1.0
+            if hasattr(module, 'inference'):
+                forward = module.inference
+            elif hasattr(module, 'up'):
+                forward = lambda x, module = module: module.up(module.down(x))
+            else:
+                continue
+            index.setdefault(name, []).append((i, forward, alpha, tooutputs, name.startswith("diffusion_model")))
+    return {name: tuple(entries) for name, entries in index.items()}
+
 def lora_forward(module, input, res):
     import lora
 
@@ -1483,30 +2395,26 @@ def lora_forward(module, input, res):
         if lora_layer_name == TE_START_NAME:
             regioner.te_start()
         elif lora_layer_name == UNET_START_NAME:
-            regioner.u_start()
+            regioner.u_start(input.shape[0])
 
-    for lora_m in lora.loaded_loras:
-        module = lora_m.modules.get(lora_layer_name, None)
+    entries = loraindex.get(lora_layer_name)
+    if entries is None: # Most layers have no LoRA.
+        return res
+
+    for i, forward, alpha, tooutputs, unet in entries:
+        lora_m = lora.loaded_loras[i]
         if labug and lora_layer_name is not None :
             if "9" in lora_layer_name and ("_attn1_to_q" in lora_layer_name or "self_attn_q_proj" in lora_layer_name): print(lora_m.multiplier,lora_m.name,lora_layer_name)
-        if module is not None and lora_m.multiplier:
-            if hasattr(module, 'up'):
-                scale = lora_m.multiplier * (module.alpha / module.up.weight.size(1) if module.alpha else 1.0)
-            else:
-                scale = lora_m.multiplier * (module.alpha / module.dim if module.alpha else 1.0)
-            
-            if hasattr(shared.opts,"lora_apply_to_outputs"):
-                if shared.opts.lora_apply_to_outputs and res.shape == input.shape:
-                    x = res
-                else:
-                    x = input    
-            else:
-                x = input
-        
-            if hasattr(module, 'inference'):
-                res = res + module.inference(x) * scale
-            elif hasattr(module, 'up'):
-                res = res + module.up(module.down(x)) * scale
+        if unet and lactive and regioner.batched and regioner.mults is not None:
+            # Every row of the pass has the multiplier of its area.
+            mults = regioner.mults[i]
+            if mults is not None:
+                x = res if tooutputs and res.shape == input.shape else input
+                out = forward(x)
+                res = res + out * (mults.to(out.device, out.dtype) * alpha).view(-1, *[1] * (out.dim() - 1))
+        elif lora_m.multiplier:
+            x = res if tooutputs and res.shape == input.shape else input
+            res = res + forward(x) * (lora_m.multiplier * alpha)
 
     return res
 
@@ -1528,8 +2436,6 @@ def lora_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.Mu
     current_names = getattr(self, "lora_current_names", ())
     wanted_names = tuple((x.name, x.multiplier) for x in loramodule.loaded_loras)
 
-    if lactive : current_names = None
-
     weights_backup = getattr(self, "lora_weights_backup", None)
     if weights_backup is None:
         if isinstance(self, torch.nn.MultiheadAttention):
@@ -1539,6 +2445,16 @@ def lora_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.Mu
 
         self.lora_weights_backup = weights_backup
 
+    if lactive and current_names != wanted_names:
+        # Regions switch multipliers every pass, swap in the merged weights of each set if kept.
+        # Only MultiheadAttention layers get here, Linear / Conv2d add LoRA outputs in lora_forward.
+        merged = getattr(self, "lora_rp_merged", {}).get(wanted_names)
+        if merged is not None:
+            for weight, cached in zip(loraweights(self), merged):
+                weight.copy_(cached)
+            setattr(self, "lora_current_names", wanted_names)
+            return
+
     if current_names != wanted_names:
         if weights_backup is not None:
             if isinstance(self, torch.nn.MultiheadAttention):
@@ -1574,6 +2490,37 @@ def lora_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.Mu
             print(f'failed to calculate lora weights for layer {lora_layer_name}')
 
         setattr(self, "lora_current_names", wanted_names)
+        if lactive:
+            lorastore(self, wanted_names)
+
+def loraweights(self):
+    """Weights of a layer changed by LoRA."""
+    if isinstance(self, torch.nn.MultiheadAttention):
+        return (self.in_proj_weight, self.out_proj.weight)
+    return (self.weight,)
+
+def lorastore(self, wanted_names):
+    """Keep a device copy of the merged weights of a layer for these multipliers, within loralimit.
+
+    Layers over the budget are merged again from the backup, as before.
+    """
+    global lorabytes
+    weights = loraweights(self)
+    size = sum(w.numel() * w.element_size() for w in weights)
+    if lorabytes + size > loralimit:
+        return
+    if not hasattr(self, "lora_rp_merged"):
+        self.lora_rp_merged = {}
+    self.lora_rp_merged[wanted_names] = tuple(w.detach().clone() for w in weights)
+    lorabytes += size
+
+def clearloracache(p):
+    """Free the merged LoRA weights kept by lorastore."""
+    global lorabytes
+    for name,module in p.sd_model.named_modules():
+        if hasattr(module, "lora_rp_merged"):
+            del module.lora_rp_merged
+    lorabytes = 0
 
 ############################################################
 ##### for new lora apply method in web-ui
@@ -1584,33 +2531,70 @@ def lora_Linear_forward(self, input):
 def lora_Conv2d_forward(self, input):
     return lora_forward(self, input, torch.nn.Conv2d_forward_before_lora(self, input))
 
-def changethedevice(module):
+def loraparams(module):
+    """(owner, attribute) of every tensor of a LoRA module that lives on the model device."""
+    params = []
     if type(module).__name__ == "LoraUpDownModule":
         if hasattr(module,"up_model") :
-            module.up_model.weight = torch.nn.Parameter(module.up_model.weight.to(devices.device, dtype = torch.float))
-            module.down_model.weight = torch.nn.Parameter(module.down_model.weight.to(devices.device, dtype=torch.float))
+            params += [(module.up_model, "weight"), (module.down_model, "weight")]
         else:
-            module.up.weight = torch.nn.Parameter(module.up.weight.to(devices.device, dtype = torch.float))
+            params.append((module.up, "weight"))
             if hasattr(module.down, "weight"):
-                module.down.weight = torch.nn.Parameter(module.down.weight.to(devices.device, dtype=torch.float))
-        
+                params.append((module.down, "weight"))
+
     elif type(module).__name__ == "LoraHadaModule":
-        module.w1a = torch.nn.Parameter(module.w1a.to(devices.device, dtype=torch.float))
-        module.w1b = torch.nn.Parameter(module.w1b.to(devices.device, dtype=torch.float))
-        module.w2a = torch.nn.Parameter(module.w2a.to(devices.device, dtype=torch.float))
-        module.w2b = torch.nn.Parameter(module.w2b.to(devices.device, dtype=torch.float))
-        
-        if module.t1 is not None:
-            module.t1 = torch.nn.Parameter(module.t1.to(devices.device, dtype=torch.float))
+        params += [(module, name) for name in ("w1a", "w1b", "w2a", "w2b")]
+        params += [(module, name) for name in ("t1", "t2") if getattr(module, name) is not None]
 
-        if module.t2 is not None:
-            module.t2 = torch.nn.Parameter(module.t2.to(devices.device, dtype=torch.float))
-        
     elif type(module).__name__ == "FullModule":
-        module.weight = torch.nn.Parameter(module.weight.to(devices.device, dtype=torch.float))
-    
-    if hasattr(module, 'bias') and module.bias != None:
-        module.bias = torch.nn.Parameter(module.bias.to(devices.device, dtype=torch.float))
+        params.append((module, "weight"))
+
+    if hasattr(module, 'bias') and module.bias is not None:
+        params.append((module, "bias"))
+    return params
+
+def changethedevice(module, device = None):
+    """Move a LoRA module to device (the model one by default) as float, returns its size in bytes."""
+    device = devices.device if device is None else device
+    size = 0
+    for owner, name in loraparams(module):
+        param = torch.nn.Parameter(getattr(owner, name).to(device, dtype = torch.float))
+        setattr(owner, name, param)
+        size += param.numel() * param.element_size()
+    return size
+
+def placeloras(loras):
+    """Move the loaded LoRAs to the model device, skipping the ones already there from earlier jobs.
+
+    LoRAs are known by name and file time, and held weakly: once the web-ui drops one,
+    a later use loads it again from disk, so it is freed instead of kept on the device.
+    Those over loraplacelimit that are not loaded now go back to the cpu, least recently used first.
+    """
+    keys = []
+    for lora in loras:
+        key = (lora.name, getattr(lora, "mtime", None))
+        keys.append(key)
+        placed = loraplaced.get(key)
+        if placed is None or placed[0]() is not lora: # Reloaded by the web-ui, on cpu again.
+            size = sum(changethedevice(module) for module in lora.modules.values())
+            loraplaced[key] = (weakref.ref(lora), size)
+            if labug : print(f"LoRA {lora.name} to {devices.device}, {size // 2 ** 20} MB")
+        loraplaced.move_to_end(key)
+
+    for key in [key for key, (ref, _) in loraplaced.items() if ref() is None]: # Dropped by the web-ui.
+        del loraplaced[key]
+    total = sum(size for _, size in loraplaced.values())
+    for key in list(loraplaced.keys()):
+        if total <= loraplacelimit:
+            break
+        if key in keys:
+            continue
+        ref, size = loraplaced.pop(key)
+        lora = ref()
+        if lora is not None:
+            for module in lora.modules.values():
+                changethedevice(module, devices.cpu)
+        total -= size
 
 def restoremodel(p):
     model = p.sd_model
@@ -1623,3 +2607,4 @@ def restoremodel(p):
                 else:
                     module.weight.copy_(module.lora_weights_backup)
                 module.lora_weights_backup = None
+    clearloracache(p)
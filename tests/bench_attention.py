@@ -0,0 +1,133 @@
+"""Attention mode benchmarks on CPU, run with python tests/bench_attention.py [name ...].
+
+Not a test module, the runner does not collect it. Times are the median of a few runs after a warm up,
+so only compare numbers from one machine and thread count.
+"""
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import types
+
+import torch
+
+from stubs import loadrp
+from test_attention import CrossAttention, attentionscript
+
+REPEAT = 3
+
+class SDPAttention(CrossAttention):
+    """Layer whose own forward (layers outside the region blocks, single negative) uses SDPA like the regions."""
+    def forward(self, x, context = None, mask = None):
+        return loadrp().main_forward(self, x, context, mask, 1, False, None, "SDPA", 0)
+
+def timeit(f):
+    """Median ms of REPEAT runs of f after a warm up."""
+    with torch.no_grad():
+        f()
+        times = []
+        for _ in range(REPEAT):
+            t = time.perf_counter()
+            f()
+            times.append(time.perf_counter() - t)
+    return statistics.median(times) * 1e3
+
+def gridlayout(rp, rows, cols, usebase):
+    """Even rows x cols matrix layout with distinct chunks per region."""
+    aratios = [rp.RegionRow(r / rows, (r + 1) / rows, [rp.RegionCell(c / cols, (c + 1) / cols, 0.2, 0) for c in range(cols)])
+               for r in range(rows)]
+    n = rows * cols + usebase
+    return dict(mode = "Horizontal", usebase = usebase, indexperiment = True, divide = rows * cols, aratios = aratios, bratios = [],
+                pt = [[i, i + 1] for i in range(n)], nt = [[i, i + 1] for i in range(n)])
+
+def batched():
+    """Region loop vs one batched call (user-001), with and without crop (user-003). 3x3 + base, 32x32 layer."""
+    rp = loadrp()
+    torch.manual_seed(0)
+    module = CrossAttention(320, 768, 8).eval()
+    layout = gridlayout(rp, 3, 3, True)
+    x = torch.randn(2, 32 * 32, 320)
+    context = torch.randn(2, 77 * len(layout["pt"]), 768)
+    for cropregions in (False, True):
+        for batchregions in (False, True):
+            script = attentionscript(rp, module, h = 256, w = 256, eq = True, batchregions = batchregions, cropregions = cropregions, **layout)
+            forward = rp.hook_forward(types.SimpleNamespace(script = script), module)
+            print(f"crop {cropregions:d} batched {batchregions:d} : {timeit(lambda: forward(x, context)):7.1f} ms")
+
+def sd15layers():
+    """The 16 attn2 layers of an SD1.5 U-Net at 512x512 as (module, x), level 0 being the 64x64 latent."""
+    torch.manual_seed(0)
+    layers = []
+    for level, (count, channels) in enumerate(((5, 320), (5, 640), (5, 1280), (1, 1280))):
+        for i in range(count):
+            module = SDPAttention(channels, 768, 8).eval()
+            module.lora_layer_name = f"diffusion_model_level{level}_{i}_attn2"
+            layers.append((module, torch.randn(2, (64 >> level) ** 2, channels)))
+    return layers
+
+def unetpass(rp, layers, context, **kw):
+    """Time of the attn2 layers of one UNet pass, 2x2 + base with SDPA."""
+    script = attentionscript(rp, layers[0][0], h = 512, w = 512, backend = "SDPA", batch_size = 1, **gridlayout(rp, 2, 2, True))
+    for k, v in kw.items():
+        setattr(script, k, v)
+    hooks = [(rp.hook_forward(types.SimpleNamespace(script = script), module), x) for module, x in layers]
+    cfgrows = script.cfgrows
+    def run():
+        script.cfgrows = cfgrows and list(cfgrows)
+        for forward, x in hooks:
+            forward(x, context)
+    return timeit(run), script
+
+def blocks():
+    """Region blocks (user-022): all, fewer and no regional layers, without and with crop."""
+    rp = loadrp()
+    layers = sd15layers()
+    context = torch.randn(2, 77 * 5, 768)
+    for cropregions in (False, True):
+        for text in ("", "1,2,3", "2,3", "9"):
+            ms, script = unetpass(rp, layers, context, eq = True, cropregions = cropregions, blocks = rp.blockfilter(text))
+            regional = sum(rp.regionblock(script, module, x.size()[1]) for module, x in layers)
+            print(f"crop {cropregions:d} blocks {text or 'all':6s} regional layers {regional:2d}/16 : {ms:7.1f} ms")
+
+def singleneg():
+    """Single negative pass (user-024): cond and uncond rows of one image in a pass, without and with crop."""
+    rp = loadrp()
+    layers = sd15layers()
+    context = torch.randn(2, 77 * 5, 768)
+    for cropregions in (False, True):
+        for single in (False, True):
+            ms, _ = unetpass(rp, layers, context, eq = True, cropregions = cropregions, singleneg = single, cfgrows = [1, 2, 0])
+            print(f"crop {cropregions:d} single negative {single:d} : {ms:7.1f} ms")
+
+def backend(name, slicesize):
+    """One 128x128 layer, batch 2, 8 heads, 231 context tokens: peak RSS growth of the first call, then time."""
+    rp = loadrp()
+    torch.manual_seed(0)
+    module = CrossAttention(320, 768, 8).eval()
+    x = torch.randn(2, 128 * 128, 320)
+    context = torch.randn(2, 231, 768)
+    forward = lambda: rp.main_forward(module, x, context, None, 1, False, None, name, slicesize)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with torch.no_grad():
+        forward()
+    grow = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024 # KB on Linux.
+    print(f"{timeit(forward):7.1f} ms, peak +{grow:.0f} MB")
+
+def backends():
+    """Einsum, SDPA and Sliced backends (user-004), each in its own process so peaks don't hide each other."""
+    for name, slicesize in (("Einsum", 0), ("SDPA", 0), ("Sliced", 4096), ("Sliced", 1024)):
+        out = subprocess.run([sys.executable, __file__, "backend", name, str(slicesize)],
+                             capture_output = True, text = True, check = True).stdout
+        print(f"{name}{f' {slicesize}' if slicesize else ''} : {out.strip()}")
+
+BENCHES = {"batched": batched, "backends": backends, "blocks": blocks, "singleneg": singleneg}
+
+if __name__ == "__main__":
+    torch.set_num_threads(4)
+    if sys.argv[1:2] == ["backend"]: # Child of backends.
+        backend(sys.argv[2], int(sys.argv[3]))
+        sys.exit()
+    for name in sys.argv[1:] or BENCHES:
+        print(f"== {name}")
+        BENCHES[name]()
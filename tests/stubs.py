@@ -0,0 +1,56 @@
+"""Stubs of the web-ui modules, so scripts/rp.py loads with only torch, numpy and einops."""
+import importlib
+import importlib.util
+import os
+import sys
+import types
+
+import einops
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def stub(name, **attrs):
+    module = sys.modules.get(name)
+    if module is None:
+        module = types.ModuleType(name)
+        sys.modules[name] = module
+        parent, _, child = name.rpartition(".")
+        if parent:
+            setattr(stub(parent), child, module)
+    for k, v in attrs.items():
+        setattr(module, k, v)
+    return module
+
+def optional(name, **attrs):
+    """Stub a module only when it is not installed, the tests don't use it."""
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        stub(name, **attrs)
+
+def loadrp(name = "rp"):
+    """scripts/rp.py as module name, another name loads it again as webui does on a reload."""
+    if name in sys.modules:
+        return sys.modules[name]
+    optional("matplotlib.style", available = [])
+    optional("PIL")
+    optional("regex", R = None)
+    optional("gradio")
+    stub("modules.ui")
+    stub("modules.shared", batch_cond_uncond = True, opts = types.SimpleNamespace())
+    stub("modules.scripts", Script = object)
+    stub("modules.extra_networks")
+    stub("modules.devices", device = torch.device("cpu"), dtype = torch.float32)
+    stub("modules.paths")
+    stub("modules.sd_hijack", model_hijack = types.SimpleNamespace(embedding_db = types.SimpleNamespace(word_embeddings = {})))
+    stub("modules.processing", Processed = object)
+    stub("modules.script_callbacks", CFGDenoisedParams = object, CFGDenoiserParams = object,
+         on_cfg_denoised = lambda f: None, on_cfg_denoiser = lambda f: None)
+    stub("ldm.modules.attention", einsum = torch.einsum, rearrange = einops.rearrange, repeat = einops.repeat,
+         default = lambda v, d: d if v is None else v, exists = lambda v: v is not None)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, "scripts", "rp.py"))
+    rp = importlib.util.module_from_spec(spec)
+    sys.modules[name] = rp
+    spec.loader.exec_module(rp)
+    return rp
@@ -0,0 +1,322 @@
+"""Attention mode regression tests on CPU, run with python -m unittest discover tests."""
+import types
+import unittest
+from unittest import mock
+
+import torch
+
+from stubs import loadrp
+
+class CrossAttention(torch.nn.Module):
+    def __init__(self, dim = 32, cdim = 24, heads = 4):
+        super().__init__()
+        self.heads = heads
+        self.scale = (dim // heads) ** -0.5
+        self.to_q = torch.nn.Linear(dim, dim, bias = False)
+        self.to_k = torch.nn.Linear(cdim, dim, bias = False)
+        self.to_v = torch.nn.Linear(cdim, dim, bias = False)
+        self.to_out = torch.nn.Sequential(torch.nn.Linear(dim, dim))
+        self.lora_layer_name = "attn2"
+
+    def forward(self, x, context = None, mask = None):
+        return loadrp().main_forward(self, x, context, mask, 1)
+
+def attentionscript(rp, module, **kw):
+    self = rp.Script()
+    self.active = True
+    self.calcmode = "Attention"
+    self.h, self.w = 512, 384
+    self.batch_size = 2
+    self.debug = False
+    self.isvanilla = False
+    self.basebreak = 0
+    self.passmodule = module
+    for k, v in kw.items():
+        setattr(self, k, v)
+    return self
+
+def regionlayouts(rp):
+    """Matrix and 1d layouts with and without base, in both modes."""
+    for mode in ("Horizontal", "Vertical"):
+        for usebase in (False, True):
+            rows = [rp.RegionRow(0, 0.4, [rp.RegionCell(0, 0.3, 0.2, 0), rp.RegionCell(0.3, 1, 0.5, 0)]),
+                    rp.RegionRow(0.4, 1, [rp.RegionCell(0, 0.5, 0.1, 0), rp.RegionCell(0.5, 0.7, 0.3, 0), rp.RegionCell(0.7, 1, 0, 0)])]
+            n = 5 + usebase
+            yield dict(mode = mode, usebase = usebase, indexperiment = True, divide = 5, aratios = rows, bratios = [],
+                       pt = [[i, i + 1] for i in range(n)], nt = [[i, i + 1] for i in range(n)])
+            n = 3 + usebase
+            yield dict(mode = mode, usebase = usebase, indexperiment = False, divide = 3, aratios = [[0, 0.3], [0.3, 0.55], [0.55, 1.0]],
+                       bratios = [0.2, 0.3, 0.4], pt = [[i, i + 1] for i in range(n)], nt = [[i, i + 1] for i in range(n)])
+
+def rolepasses(rp, module, x, context, **kw):
+    """Cond pass, uncond pass and a pass mixing them (CFG rows recorded), by rows of x."""
+    script = attentionscript(rp, module, eq = False, **kw)
+    forward = rp.hook_forward(types.SimpleNamespace(script = script), module)
+    with torch.no_grad():
+        outs = [forward(x[:2], context[:2]), forward(x[2:], context[2:])]
+        script.cfgrows = [2, 4, 0]
+        outs.append(forward(x, context))
+    return torch.cat(outs)
+
+class TestBatchedRegions(unittest.TestCase):
+    """All regions in one attention call give the same result as the per region loop."""
+
+    def test_equal_to_loop(self):
+        rp = loadrp()
+        torch.manual_seed(0)
+        module = CrossAttention().eval()
+        x = torch.randn(4, 64 * 48, 32)
+        for layout in regionlayouts(rp):
+            context = torch.randn(4, 77 * len(layout["pt"]), 24)
+            for backend in ("Einsum", "SDPA"):
+                outs = [rolepasses(rp, module, x, context, batchregions = batchregions, cropregions = False, backend = backend, **layout)
+                        for batchregions in (False, True)]
+                self.assertTrue(torch.allclose(outs[0], outs[1], atol = 1e-5), (layout["mode"], layout["usebase"], layout["indexperiment"], backend))
+
+class TestCroppedRegions(unittest.TestCase):
+    """Attending only the query tokens each region keeps gives the same result as the whole layer."""
+
+    def test_equal_to_uncropped(self):
+        rp = loadrp()
+        torch.manual_seed(0)
+        module = CrossAttention().eval()
+        x = torch.randn(4, 64 * 48, 32)
+        for layout in regionlayouts(rp):
+            context = torch.randn(4, 77 * len(layout["pt"]), 24)
+            for batchregions in (False, True):
+                outs = [rolepasses(rp, module, x, context, batchregions = batchregions, cropregions = cropregions, **layout)
+                        for cropregions in (False, True)]
+                self.assertTrue(torch.allclose(outs[0], outs[1], atol = 1e-5), (layout["mode"], layout["usebase"], layout["indexperiment"], batchregions))
+
+    def test_feather(self):
+        rp = loadrp()
+        torch.manual_seed(0)
+        module = CrossAttention().eval()
+        x = torch.randn(4, 64 * 48, 32)
+        for layout in regionlayouts(rp):
+            context = torch.randn(4, 77 * len(layout["pt"]), 24)
+            for batchregions in (False, True):
+                outs = [rolepasses(rp, module, x, context, batchregions = batchregions, cropregions = False, feather = 24, **layout)]
+                # Feathered regions overlap, the batched path must not crop to single owners.
+                with mock.patch.object(rp, "main_forward_cropped", side_effect = AssertionError("cropped with feather")):
+                    outs.append(rolepasses(rp, module, x, context, batchregions = batchregions, cropregions = True, feather = 24, **layout))
+                self.assertTrue(torch.allclose(outs[0], outs[1], atol = 1e-5), (layout["mode"], layout["usebase"], layout["indexperiment"], batchregions))
+
+class TestNegativeChunks(unittest.TestCase):
+    """A negative with fewer BREAK chunks than regions, its last chunk fills the remaining regions."""
+
+    def test_last_chunk_fills(self):
+        rp = loadrp()
+        torch.manual_seed(0)
+        module = CrossAttention().eval()
+        layout = dict(mode = "Vertical", usebase = False, indexperiment = False, divide = 3, eq = False,
+                      aratios = [[0, 0.25], [0.25, 0.75], [0.75, 1.0]], bratios = [0, 0, 0], pt = [[0, 1], [1, 2], [2, 3]])
+        x = torch.randn(2, 64 * 48, 32)
+        context = torch.randn(2, 77 * 3, 24)
+        for batchregions in (False, True):
+            for cropregions in (False, True):
+                for cfgrows in (None, [1, 2, 0]):
+                    outs = []
+                    for nt in ([[0, 1], [1, 2]], [[0, 1], [1, 2], [1, 2]]):
+                        script = attentionscript(rp, module, nt = nt, batchregions = batchregions, cropregions = cropregions, **layout)
+                        forward = rp.hook_forward(types.SimpleNamespace(script = script), module)
+                        with torch.no_grad():
+                            if cfgrows is None: # Cond pass, then uncond.
+                                outs.append(torch.cat([forward(x, context), forward(x, context)]))
+                            else:
+                                script.cfgrows = list(cfgrows)
+                                outs.append(forward(x, context))
+                    self.assertTrue(torch.equal(outs[0], outs[1]), (batchregions, cropregions, cfgrows))
+
+class TestSingleNegative(unittest.TestCase):
+    """The single negative pass only changes the uncond rows of a mixed pass."""
+
+    def test_cond_rows_unchanged(self):
+        rp = loadrp()
+        torch.manual_seed(0)
+        module = CrossAttention().eval()
+        layout = dict(mode = "Horizontal", usebase = False, indexperiment = False, divide = 2,
+                      aratios = [[0, 0.4], [0.4, 1.0]], bratios = [0, 0], pt = [[0, 1], [1, 2]], nt = [[0, 1], [1, 2]])
+        x = torch.randn(4, 64 * 48, 32)
+        context = torch.randn(4, 77 * 2, 24)
+        for eq in (False, True):
+            for batchregions in (False, True):
+                for cfgrows in (None, [2, 4, 0]):
+                    outs = []
+                    for singleneg in (False, True):
+                        script = attentionscript(rp, module, eq = eq, singleneg = singleneg, batchregions = batchregions,
+                                                 cfgrows = cfgrows and list(cfgrows), **layout)
+                        forward = rp.hook_forward(types.SimpleNamespace(script = script), module)
+                        with torch.no_grad(): # Without cfgrows, the halves of the batch are cond and uncond passes.
+                            outs.append(forward(x, context) if cfgrows else torch.cat([forward(x[:2], context[:2]), forward(x[2:], context[2:])]))
+                    self.assertTrue(torch.equal(outs[0][:2], outs[1][:2]), (eq, batchregions, cfgrows))
+                    with torch.no_grad():
+                        self.assertTrue(torch.allclose(outs[1][2:], module(x[2:], context[2:]), atol = 1e-6))
+
+class TestSampleLayouts(unittest.TestCase):
+    """Images with their own layouts in one batch give the same result as alone."""
+
+    def test_negatives_of_other_lengths(self):
+        rp = loadrp()
+        torch.manual_seed(0)
+        module = CrossAttention().eval()
+        layout = dict(mode = "Horizontal", usebase = False, indexperiment = False, divide = 3,
+                      aratios = [[0, 0.3], [0.3, 0.6], [0.6, 1.0]], bratios = [0, 0, 0], pt = [[0, 1], [1, 2], [2, 3]])
+        nts = ([[0, 1], [1, 2], [2, 3]], [[0, 1]]) # "n BREAK m BREAK o" and "k", only the first is eq.
+        x = torch.randn(4, 64 * 48, 32)
+        context = torch.randn(4, 77 * 3, 24)
+        for singleneg in (False, True):
+            for cfgrows in (None, [2, 4, 0]):
+                layouts = [attentionscript(rp, module, nt = nt, eq = len(nt) == 3, singleneg = singleneg, **layout) for nt in nts]
+                script = attentionscript(rp, module, nt = nts[0], eq = False, singleneg = singleneg, cfgrows = cfgrows and list(cfgrows),
+                                         layouts = layouts, rowlayouts = (0, 1), **layout)
+                forward = rp.hook_forward(types.SimpleNamespace(script = script), module)
+                with torch.no_grad():
+                    out = forward(x, context) if cfgrows else torch.cat([forward(x[:2], context[:2]), forward(x[2:], context[2:])])
+                for i, nt in enumerate(nts):
+                    alone = attentionscript(rp, module, nt = nt, eq = len(nt) == 3, singleneg = singleneg, batch_size = 1,
+                                            cfgrows = cfgrows and [1, 2, 0], **layout)
+                    forward = rp.hook_forward(types.SimpleNamespace(script = alone), module)
+                    rows = [i, 2 + i]
+                    with torch.no_grad():
+                        ref = forward(x[rows], context[rows]) if cfgrows else torch.cat([forward(x[[i]], context[[i]]), forward(x[[2 + i]], context[[2 + i]])])
+                    self.assertTrue(torch.allclose(out[rows], ref, atol = 1e-6), (singleneg, cfgrows, i))
+
+    def test_eq_cond_rows_with_single_negative(self):
+        rp = loadrp()
+        torch.manual_seed(0)
+        module = CrossAttention().eval()
+        layout = dict(mode = "Horizontal", usebase = False, indexperiment = False, divide = 2,
+                      aratios = [[0, 0.4], [0.4, 1.0]], bratios = [0, 0], pt = [[0, 1], [1, 2]])
+        nts = ([[0, 1], [1, 2]], [[0, 1]]) # Only the first layout is eq.
+        x = torch.randn(4, 64 * 48, 32)
+        context = torch.randn(4, 77 * 2, 24)
+        for rowlayouts, cfgrows in (((0, 1), [2, 4, 0]), ((1, 0), [2, 4, 0]), ((0, 0), [2, 4, 0])):
+            outs = []
+            for singleneg in (False, True):
+                layouts = [attentionscript(rp, module, nt = nt, eq = len(nt) == 2, singleneg = singleneg, **layout) for nt in nts]
+                script = attentionscript(rp, module, nt = nts[1], eq = False, singleneg = singleneg, cfgrows = list(cfgrows),
+                                         layouts = layouts, rowlayouts = rowlayouts, **layout)
+                with torch.no_grad():
+                    outs.append(rp.hook_forward(types.SimpleNamespace(script = script), module)(x, context))
+            ncond = cfgrows[0]
+            rows = [r for r in range(ncond) if rowlayouts[r * 2 // ncond] == 0] # Cond rows of the eq image.
+            self.assertTrue(torch.equal(outs[0][rows], outs[1][rows]), (rowlayouts, cfgrows))
+
+    def test_hires_prompts_in_keys(self):
+        rp = loadrp()
+        with mock.patch.object(rp, "tokencount", lambda model, chunk: len(chunk.split())):
+            self.hires_prompts_in_keys(rp)
+
+    def hires_prompts_in_keys(self, rp):
+        rp.shared.sd_model = None
+        prompts = ["x BREAK c BREAK c BREAK y", "z BREAK y"]
+        samples = [(pr, "n", "1,1,1,1") for pr in prompts]
+        for hrprompt, distinct in (("x BREAK c BREAK c BREAK y", 3), ("x BREAK c BREAK d BREAK y", 4)):
+            script = rp.Script()
+            script.mode = "Horizontal"
+            script.calcmode = "Attention"
+            script.batch_size = 2
+            script.debug = False
+            p = types.SimpleNamespace(prompt = prompts[0], negative_prompt = "n", all_prompts = list(prompts), all_negative_prompts = ["n", "n"],
+                                      all_hr_prompts = [hrprompt, prompts[1]], all_hr_negative_prompts = ["n", "n"])
+            script, p = rp.sampledealer(script, p, samples, "0", False, False, False)
+            self.assertEqual(script.layoutindex, [0, 1])
+            # Equal chunks share a context only if they are also equal in the hires. prompt.
+            self.assertEqual(len(set(script.layouts[0].ptkeys)), distinct)
+
+class TestCFGRows(unittest.TestCase):
+    """Cond / uncond rows of the CFG batch are counted from its conds, not assumed from the batch size."""
+
+    def test_split(self):
+        rp = loadrp()
+        script = attentionscript(rp, None)
+        def params(rows, ncond, nuncond, sdxl = False):
+            cond = torch.zeros(ncond, 77, 24)
+            return types.SimpleNamespace(x = torch.zeros(rows, 4, 8, 8), sampling_step = 0, total_sampling_steps = 20, sigma = torch.ones(rows),
+                                         text_cond = {"crossattn": cond, "vector": torch.zeros(ncond, 8)} if sdxl else cond,
+                                         text_uncond = torch.zeros(nuncond, 77, 24))
+        cases = [((4, 2, 2), [2, 4, 0]), ((6, 4, 2), [4, 6, 0]), # Two conds per image with AND.
+                 ((2, 2, 2), [2, 2, 0]), # Uncond skipped.
+                 ((3, 2, 2), None), ((6, 2, 2), None)] # Doesn't add up, alternating passes.
+        for sdxl in (False, True):
+            for args, cfgrows in cases:
+                script.denoiser_callback(params(*args, sdxl = sdxl))
+                self.assertEqual(script.cfgrows, cfgrows, (args, sdxl))
+        stale = types.SimpleNamespace(x = torch.zeros(4, 4, 8, 8), sampling_step = 0, total_sampling_steps = 20, sigma = torch.ones(4))
+        script.denoiser_callback(stale)
+        self.assertIsNone(script.cfgrows)
+
+    def test_skipped_uncond(self):
+        rp = loadrp()
+        torch.manual_seed(0)
+        module = CrossAttention().eval()
+        layout = dict(mode = "Horizontal", usebase = False, indexperiment = False, divide = 2, eq = False,
+                      aratios = [[0, 0.4], [0.4, 1.0]], bratios = [0, 0], pt = [[0, 1], [1, 2]], nt = [[0, 1]])
+        x = torch.randn(2, 64 * 48, 32)
+        context = torch.randn(2, 77 * 2, 24)
+        script = attentionscript(rp, module, **layout)
+        params = types.SimpleNamespace(x = torch.zeros(2, 4, 8, 8), sampling_step = 0, total_sampling_steps = 20, sigma = torch.ones(2),
+                                       text_cond = torch.zeros(2, 77, 24), text_uncond = torch.zeros(2, 77, 24))
+        forward = rp.hook_forward(types.SimpleNamespace(script = script), module)
+        with torch.no_grad():
+            outs = []
+            for _ in range(2): # Cond only passes on two steps, not alternating with uncond.
+                script.denoiser_callback(params)
+                outs.append(forward(x, context))
+            script.cfgrows = None
+            script.pn = True
+            ref = forward(x, context) # Cond pass without CFG rows.
+        self.assertTrue(torch.equal(outs[0], ref))
+        self.assertTrue(torch.equal(outs[1], ref))
+
+class TestTokenCache(unittest.TestCase):
+    """Token counts of prompt chunks are cached until the embeddings they may name change."""
+
+    def test_embeddings(self):
+        rp = loadrp()
+        db = rp.sd_hijack.model_hijack.embedding_db
+        def tokenize_line(chunk): # Words, embeddings count their vectors.
+            words = chunk.split()
+            return None, sum(getattr(db.word_embeddings.get(w), "vectors", 1) for w in words)
+        rp.shared.sd_model = types.SimpleNamespace(sd_model_hash = "test", cond_stage_model = types.SimpleNamespace(tokenize_line = tokenize_line))
+        p = types.SimpleNamespace(prompt = "a emb b BREAK c", negative_prompt = "n")
+        self.assertEqual(rp.tokendealer(p)[2], [3, 1])
+        db.word_embeddings["emb"] = types.SimpleNamespace(vectors = 80) # Loaded between jobs.
+        try:
+            pt, nt, ppt, pnt, eq = rp.tokendealer(p)
+        finally:
+            del db.word_embeddings["emb"]
+        self.assertEqual(ppt, [82, 1])
+        self.assertEqual(pt, [[0, 2], [2, 3]])
+        self.assertEqual(rp.tokendealer(p)[2], [3, 1])
+
+class TestHooks(unittest.TestCase):
+    """Hooks are made once per layer and made again for a reloaded script."""
+
+    def test_reload(self):
+        rp = loadrp()
+        torch.manual_seed(0)
+        root = torch.nn.Module()
+        root.attn2 = module = CrossAttention().eval()
+        layout = dict(usebase = False, indexperiment = False, divide = 2, eq = True, aratios = [[0, 0.4], [0.4, 1.0]],
+                      bratios = [0, 0], pt = [[0, 1], [1, 2]], nt = [[0, 1], [1, 2]])
+        x = torch.randn(2, 64 * 48, 32)
+        context = torch.randn(2, 77 * 2, 24)
+        rp.hook_forwards(attentionscript(rp, module, mode = "Horizontal", **layout), root)
+        forward = module.forward
+        rp.hook_forwards(attentionscript(rp, module, mode = "Horizontal", **layout), root, remove = True)
+        rp.hook_forwards(attentionscript(rp, module, mode = "Horizontal", **layout), root)
+        self.assertIs(module.forward, forward)
+        reloaded = loadrp("rp_reloaded")
+        script = attentionscript(reloaded, module, mode = "Vertical", **layout)
+        reloaded.hook_forwards(script, root)
+        self.assertIsNot(module.forward, forward)
+        with torch.no_grad():
+            out = module.forward(x, context)
+            ref = reloaded.hook_forward(types.SimpleNamespace(script = script), module)(x, context)
+        self.assertTrue(torch.equal(out, ref))
+        rp.hook_forwards(script, root, remove = True)
+
+if __name__ == "__main__":
+    unittest.main()
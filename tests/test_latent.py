@@ -0,0 +1,97 @@
+"""Latent mode regression tests on CPU, run with python -m unittest discover tests.
+
+The web-ui modules are replaced by small stubs, see stubs.py.
+"""
+import types
+import unittest
+
+import torch
+
+from stubs import loadrp
+
+def latentscript(rp, batch, aratios, onechannel):
+    self = rp.Script()
+    self.active = True
+    self.calcmode = "Latent"
+    self.mode = "Horizontal"
+    self.batch_size = batch
+    self.aratios = aratios
+    self.bratios = [0] * len(aratios)
+    self.onechannel = onechannel
+    self.debug = False
+    return self
+
+def ratios(areas):
+    return [[a / areas, (a + 1) / areas] for a in range(areas)]
+
+class TestComposite(unittest.TestCase):
+    """denoised_callback against the loops it replaced."""
+
+    def oldcomposite(self, rp, x, batch, aratios):
+        filters = rp.makefilters(x.shape[1], x.shape[2], x.shape[3], aratios, "Horizontal", False, [0] * len(aratios), False)
+        neg_filters = [1 - f for f in filters]
+        xt = x.clone()
+        areas = xt.shape[0] // batch - 1
+        for b in range(batch):
+            for a in range(areas):
+                x[a + b * areas] = xt[b + a * batch]
+        for b in range(batch):
+            for a in range(areas):
+                x[a + b * areas, :, :, :] = x[a + b * areas, :, :, :] * filters[a] + x[x.size()[0] + (b - batch), :, :, :] * neg_filters[a]
+        return x
+
+    def test_equal_to_loop(self):
+        rp = loadrp()
+        rp.lactive = True
+        torch.manual_seed(0)
+        for batch in (1, 2, 3, 8):
+            for areas in (1, 2, 4, 5):
+                for onechannel in (False, True):
+                    x = torch.randn(areas * batch + batch, 4, 16, 24)
+                    script = latentscript(rp, batch, ratios(areas), onechannel)
+                    params = types.SimpleNamespace(x = x.clone())
+                    script.denoised_callback(params)
+                    ref = self.oldcomposite(rp, x.clone(), batch, ratios(areas))
+                    self.assertTrue(torch.equal(params.x, ref), (batch, areas, onechannel))
+
+class TestAreaOrder(unittest.TestCase):
+    """denoiser_callback regrouping against the loop it replaced."""
+
+    def oldorder(self, t, batch):
+        tt = t.clone()
+        areas = tt.shape[0] // batch - 1
+        for a in range(areas):
+            for b in range(batch):
+                t[b + a * batch] = tt[a + b * areas]
+        return t
+
+    def test_same_order_as_loop(self):
+        rp = loadrp()
+        rp.lactive = True
+        for batch in range(1, 5):
+            for areas in range(1, 6):
+                rows = areas * batch + batch
+                script = latentscript(rp, batch, ratios(areas), True)
+                script.active = False
+                x, image_cond, sigma = torch.randn(rows, 4, 8, 8), torch.randn(rows, 5, 8, 8), torch.rand(rows)
+                cond, crossattn = torch.randn(rows, 77, 16), torch.randn(rows, 77, 16)
+                params = types.SimpleNamespace(x = x.clone(), image_cond = image_cond.clone(), sigma = sigma.clone(),
+                                               text_cond = {"crossattn": crossattn.clone(), "vector": cond.clone()})
+                script.denoiser_callback(params)
+                self.assertTrue(torch.equal(params.x, self.oldorder(x.clone(), batch)))
+                self.assertTrue(torch.equal(params.image_cond, self.oldorder(image_cond.clone(), batch)))
+                self.assertTrue(torch.equal(params.sigma, self.oldorder(sigma.clone(), batch)))
+                self.assertTrue(torch.equal(params.text_cond["crossattn"], self.oldorder(crossattn.clone(), batch)))
+                self.assertTrue(torch.equal(params.text_cond["vector"], self.oldorder(cond.clone(), batch)))
+
+    def test_inverse(self):
+        rp = loadrp()
+        script = latentscript(rp, 3, ratios(4), True)
+        order = rp.areaorder(script, 3, 4, "cpu")
+        inverse = rp.areaorder(script, 3, 4, "cpu", inverse = True)
+        rows = torch.arange(12)
+        self.assertTrue(torch.equal(rows[order][inverse], rows))
+        self.assertIs(rp.areaorder(script, 3, 4, "cpu"), order) # Cached per size.
+
+if __name__ == "__main__":
+    unittest.main()